@@ -0,0 +1,219 @@
+"""
+Local stand-in for Plex Media Server, serving just enough of the API for plexiglas: server identity, library
+sections, a movie library container (with paging), sync items with their media, watch history, and the media parts
+(with Range support). Latency of every response and bandwidth of every part download are configurable.
+"""
+
+import random
+import re
+import threading
+import time
+from xml.sax.saxutils import quoteattr
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import urlparse
+
+MACHINE_ID = 'f' * 40
+CLIENT_ID = 'plexiglas-benchmark'
+TOKEN = 'benchmark-token'
+SECTION_ID = 1
+
+
+class Library(object):
+    """ Content of the fake server: `movies` movies in the library and `sync_items` sync items, `items_per_sync`
+        movies each. Every movie has a single part of `part_size` bytes.
+    """
+
+    def __init__(self, movies=100, part_size=1024 ** 2, sync_items=0, items_per_sync=10):
+        self.movies = movies
+        self.part_size = part_size
+        self.sync_items = sync_items
+        self.items_per_sync = items_per_sync
+        self.updated_at = int(time.time())
+        self.downloaded = set()
+        self._block = bytes(bytearray(random.Random(0).getrandbits(8) for _ in range(64 * 1024)))
+
+    def part_data(self, offset, length):
+        """ Deterministic contents of any part, so the downloaded files could be verified. """
+        block_size = len(self._block)
+        ret = []
+        while length > 0:
+            start = offset % block_size
+            chunk = self._block[start:start + length]
+            ret.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return b''.join(ret)
+
+    def movie_xml(self, rating_key, sync_item_id=None):
+        sync_attrs = ''
+        if sync_item_id is not None:
+            sync_attrs = ' syncItemId="%d" syncState="processed"' % sync_item_id
+
+        return ('<Video ratingKey="%(key)d" key="/library/metadata/%(key)d" type="movie" title=%(title)s '
+                'year="2000" addedAt="%(added)d" originallyAvailableAt="2000-01-01" librarySectionID="%(section)d">'
+                '<Media id="%(key)d" container="mkv"><Part id="%(key)d" key="/library/parts/%(key)d/file.mkv" '
+                'size="%(size)d" container="mkv"%(sync)s /></Media></Video>') % {
+            'key': rating_key, 'title': quoteattr('Movie %05d' % rating_key), 'added': self.updated_at - rating_key,
+            'section': SECTION_ID, 'size': self.part_size, 'sync': sync_attrs}
+
+    def sync_item_xml(self, sync_id):
+        ready = self.items_per_sync - len([k for k in self.sync_media(sync_id) if k in self.downloaded])
+        return ('<SyncItem id="%(id)d" version="1" rootTitle="Movies" title=%(title)s metadataType="movie" '
+                'contentType="video"><Server machineIdentifier="%(machine)s" /><Status failureCode="" failure="" '
+                'state="pending" itemsCount="%(count)d" itemsCompleteCount="%(count)d" totalSize="%(total)d" '
+                'itemsDownloadedCount="%(downloaded)d" itemsReadyCount="%(ready)d" itemsSuccessfulCount="%(count)d" />'
+                '<MediaSettings /><Policy scope="count" unwatched="1" value="%(count)d" />'
+                '<Location uri="library://x/directory/%%2Flibrary%%2Fsections%%2F1%%2Fall" /></SyncItem>') % {
+            'id': sync_id, 'title': quoteattr('Sync %d' % sync_id), 'machine': MACHINE_ID,
+            'count': self.items_per_sync, 'total': self.items_per_sync * self.part_size,
+            'downloaded': self.items_per_sync - ready, 'ready': ready}
+
+    def sync_media(self, sync_id):
+        first = 100000 + sync_id * self.items_per_sync
+        return range(first, first + self.items_per_sync)
+
+
+class FakePlexHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def library(self):
+        return self.server.library
+
+    def send_xml(self, body):
+        time.sleep(self.server.latency)
+        body = ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, code=200):
+        time.sleep(self.server.latency)
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def container(self, items, total=None, **attrs):
+        start = int(self.headers.get('X-Plex-Container-Start', 0))
+        size = int(self.headers.get('X-Plex-Container-Size', len(items) or 1))
+        page = items[start:start + size]
+        attrs = ''.join(' %s=%s' % (k, quoteattr(str(v))) for k, v in attrs.items())
+        return '<MediaContainer size="%d" totalSize="%d"%s>%s</MediaContainer>' % (
+            len(page), len(items) if total is None else total, attrs, ''.join(page))
+
+    def do_PUT(self):
+        match = re.match(r'^/sync/[^/]+/item/(\d+)/downloaded$', urlparse(self.path).path)
+        if match:
+            self.library.downloaded.add(int(match.group(1)))
+        self.server.count('put')
+        self.send_empty()
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/') or '/'
+        lib = self.library
+        self.server.count('get')
+
+        if path in ('/', '/identity'):
+            self.send_xml('<MediaContainer machineIdentifier="%s" friendlyName="benchmark" version="1.16.0" '
+                          'myPlex="1" allowSync="1" />' % MACHINE_ID)
+        elif path == '/library/sections':
+            self.send_xml('<MediaContainer size="1"><Directory key="%d" type="movie" title="Movies" agent="x" '
+                          'scanner="x" language="en" uuid="x" updatedAt="%d" /></MediaContainer>'
+                          % (SECTION_ID, lib.updated_at))
+        elif path == '/library/sections/%d/all' % SECTION_ID:
+            movies = [lib.movie_xml(k) for k in range(1, lib.movies + 1)]
+            self.send_xml(self.container(movies, librarySectionID=SECTION_ID, librarySectionTitle='Movies'))
+        elif path == '/status/sessions/history/all':
+            self.send_xml(self.container([]))
+        elif path == '/devices/%s/sync_items' % CLIENT_ID:
+            items = ''.join(lib.sync_item_xml(i) for i in range(1, lib.sync_items + 1))
+            self.send_xml('<SyncList clientIdentifier="%s"><SyncItems>%s</SyncItems></SyncList>' % (CLIENT_ID, items))
+        elif path.startswith('/sync/items/'):
+            sync_id = int(path.split('/')[-1])
+            self.send_xml(self.container([lib.movie_xml(k, sync_id) for k in lib.sync_media(sync_id)]))
+        elif path.startswith('/library/parts/'):
+            self.send_part()
+        else:
+            self.send_empty(404)
+
+    def send_part(self):
+        size = self.library.part_size
+        start, end = 0, size - 1
+
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        time.sleep(self.server.latency)
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'video/x-matroska')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        chunk_size = 64 * 1024
+        begin = time.time()
+        sent = 0
+        offset = start
+        while offset <= end:
+            length = min(chunk_size, end - offset + 1)
+            try:
+                self.wfile.write(self.library.part_data(offset, length))
+            except (IOError, OSError):
+                return
+            offset += length
+            sent += length
+
+            if self.server.bandwidth:
+                delay = float(sent) / self.server.bandwidth - (time.time() - begin)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class FakePlexServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, library, latency=0.0, bandwidth=None, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, FakePlexHandler)
+        self.library = library
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class FakeAccount(object):
+    """ Stand-in for MyPlexAccount, which knows only about the fake server. """
+
+    def __init__(self, server):
+        self.server = server
+        self.authenticationToken = TOKEN
+
+    def syncItems(self):
+        from plexapi.sync import SyncList
+
+        return SyncList(self.server, self.server.query('/devices/%s/sync_items' % CLIENT_ID))
@@ -0,0 +1,371 @@
+"""
+Benchmarks of plexiglas against a local fake Plex server.
+
+Every benchmark runs in its own process (so the peak RSS is measured per benchmark) within a temporary destination
+directory. Usage:
+
+    python -m benchmarks.run                               # run everything
+    python -m benchmarks.run simple_sync cleanup_100k      # run selected benchmarks
+    python -m benchmarks.run --json results.json           # save the results
+    python -m benchmarks.run --baseline results.json       # fail if anything is slower than the baseline
+
+Metrics ending with `_per_s` are better when higher, all the others are better when lower.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from humanfriendly import format_size, parse_size
+
+from .fake_plex import CLIENT_ID, MACHINE_ID, SECTION_ID, TOKEN, FakeAccount, FakePlexServer, Library
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def make_opts(destination, args, *extra):
+    """ Returns the options as they would be after `cli.process_opts`, without touching the keyring. """
+    import humanfriendly as hf
+    from plexiglas import cli
+    from plexiglas.planner import parse_sync_weights
+
+    argv = ['plexiglas', '-d', destination, '--parallel-downloads', str(args.parallel_downloads),
+            '--download-segments', str(args.download_segments), '--segmented-download-min-size', '1',
+            '--download-backend', args.download_backend] + list(extra)
+
+    old_argv = sys.argv
+    sys.argv = argv
+    try:
+        opts = cli.parse_arguments()
+    finally:
+        sys.argv = old_argv
+
+    opts.segmented_download_min_size = hf.parse_size(opts.segmented_download_min_size, binary=True)
+    opts.download_chunk_size = hf.parse_size(opts.download_chunk_size, binary=True)
+    opts.metadata_cache_size = hf.parse_size(opts.metadata_cache_size, binary=True)
+    opts.sync_weight = parse_sync_weights(opts.sync_weight)
+    opts.rate_limit = cli.parse_rate_limit(opts.rate_limit)
+    opts.rate_limit_per_download = cli.parse_rate_limit(opts.rate_limit_per_download)
+    if opts.limit_disk_usage:
+        opts.limit_disk_usage = hf.parse_size(opts.limit_disk_usage, binary=True)
+
+    return opts
+
+
+def connect(fake):
+    """ Returns the fake account, with the fake server registered as the only known server. """
+    import plexapi
+    from plexapi.server import PlexServer
+    from plexiglas import plex
+
+    plex.init_plexapi('benchmark')
+    plexapi.X_PLEX_IDENTIFIER = CLIENT_ID
+
+    server = PlexServer(fake.url, TOKEN, session=plex.create_session())
+    plex._servers[MACHINE_ID] = server
+
+    return FakeAccount(server)
+
+
+def simple_sync_url(fake):
+    return '%s/web/index.html#!/server/%s?key=%%2Flibrary%%2Fsections%%2F%d%%2Fall' % (fake.url, MACHINE_ID,
+                                                                                       SECTION_ID)
+
+
+def run_plugin(plugin, account, opts):
+    """ Runs a single iteration of the plugin, including sending the download acknowledgements to the server. """
+    from plexiglas import acks, db
+    from plexiglas.content import cleanup
+    from plexiglas.planner import execute_plans
+
+    acks.start(account, opts)
+    try:
+        with db.transaction():
+            plan = plugin.plan(account, opts)
+            execute_plans(account, opts, [plan], db.get_downloaded_size())
+            cleanup(account, plugin.name, plan.required_media, opts)
+    finally:
+        acks.stop()
+
+
+def downloaded_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            if f.endswith('.mkv'):
+                total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+@benchmark
+def simple_sync(args, destination):
+    """ End-to-end SimpleSync: listing the library, downloading all the files and the cleanup. """
+    from plexiglas.simple_sync import SimpleSync
+
+    fake = FakePlexServer(Library(args.files, args.part_size), args.latency, args.bandwidth).start()
+    account = connect(fake)
+    opts = make_opts(destination, args, '--simple-sync-url', simple_sync_url(fake))
+
+    begin = time.time()
+    run_plugin(SimpleSync, account, opts)
+    seconds = time.time() - begin
+    size = downloaded_size(destination)
+
+    begin = time.time()
+    requests_before = sum(fake.requests.values())
+    run_plugin(SimpleSync, account, opts)
+
+    return {
+        'simple_sync_seconds': seconds,
+        'simple_sync_mb_per_s': size / seconds / 1024 ** 2,
+        'simple_sync_idle_seconds': time.time() - begin,
+        'simple_sync_idle_requests': sum(fake.requests.values()) - requests_before,
+    }
+
+
+@benchmark
+def mobile_sync(args, destination):
+    """ End-to-end MobileSync: sync items with `--files` media in total, downloading and marking them downloaded. """
+    from plexiglas.mobile_sync import MobileSync
+
+    sync_items = max(1, args.files // 10)
+    library = Library(0, args.part_size, sync_items, max(1, args.files // sync_items))
+    fake = FakePlexServer(library, args.latency, args.bandwidth).start()
+    account = connect(fake)
+    opts = make_opts(destination, args)
+
+    begin = time.time()
+    run_plugin(MobileSync, account, opts)
+    seconds = time.time() - begin
+    size = downloaded_size(destination)
+    assert len(library.downloaded) == sync_items * max(1, args.files // sync_items)
+
+    begin = time.time()
+    requests_before = sum(fake.requests.values())
+    run_plugin(MobileSync, account, opts)
+
+    return {
+        'mobile_sync_seconds': seconds,
+        'mobile_sync_mb_per_s': size / seconds / 1024 ** 2,
+        'mobile_sync_requests': requests_before,
+        'mobile_sync_idle_seconds': time.time() - begin,
+        'mobile_sync_idle_requests': sum(fake.requests.values()) - requests_before,
+    }
+
+
+@benchmark
+def metadata(args, destination):
+    """ Listing a big library page by page. """
+    from plexiglas import plex
+    from plexiglas.simple_sync import SimpleSync
+
+    items = args.files * 50
+    fake = FakePlexServer(Library(items, args.part_size), args.latency).start()
+    connect(fake)
+    server = plex._servers[MACHINE_ID]
+
+    begin = time.time()
+    count = sum(1 for _ in SimpleSync.iter_items(server, '/library/sections/%d/all' % SECTION_ID, 50))
+    seconds = time.time() - begin
+    assert count == items
+
+    return {
+        'metadata_seconds': seconds,
+        'metadata_items_per_s': items / seconds,
+        'metadata_request_latency': seconds / fake.requests['get'],
+    }
+
+
+def cleanup_rows(args, destination, rows):
+    """ Cleanup of `rows` DB rows, half of which are not required anymore. """
+    from plexiglas import db
+    from plexiglas.content import cleanup, sanitize_filename
+
+    class Media(object):
+        TYPE = 'movie'
+
+        def __init__(self, rating_key):
+            self.ratingKey = rating_key
+            self.title = 'Movie %d' % rating_key
+
+    opts = make_opts(destination, args)
+    syncs = 100
+    required = []
+
+    begin = time.time()
+    with db.transaction():
+        for i in range(rows):
+            sync_id = i % syncs
+            filename = 'Movie %d.mkv' % i
+            db.mark_downloaded(MACHINE_ID, 'benchmark', sync_id, 'Sync %d' % sync_id, Media(i), 1, filename)
+
+            if i % 2 == 0:
+                required.append((MACHINE_ID, i))
+                path = os.path.join(destination, 'Sync %d' % sync_id)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                open(os.path.join(path, sanitize_filename(filename)), 'w').close()
+    insert_seconds = time.time() - begin
+
+    begin = time.time()
+    report = cleanup(None, 'benchmark', required, opts)
+    seconds = time.time() - begin
+    assert len(report.removed) == rows - len(required)
+
+    return {
+        'cleanup_%dk_db_insert_seconds' % (rows // 1000): insert_seconds,
+        'cleanup_%dk_seconds' % (rows // 1000): seconds,
+    }
+
+
+@benchmark
+def cleanup_10k(args, destination):
+    return cleanup_rows(args, destination, 10000)
+
+
+@benchmark
+def cleanup_100k(args, destination):
+    return cleanup_rows(args, destination, 100000)
+
+
+def run_child(args):
+    import logging
+    from plexiglas import log
+
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+
+    destination = tempfile.mkdtemp(prefix='plexiglas-benchmark-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(destination)
+        result = BENCHMARKS[args.child](args, destination)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(destination, ignore_errors=True)
+
+    result['%s_peak_rss_kb' % args.child] = peak_rss_kb()
+    print(json.dumps(result))
+
+
+def run_benchmark(name, argv):
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.run', '--child', name] + argv,
+                               stdout=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('Benchmark %s failed' % name)
+
+    return json.loads(stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, value in sorted(results.items()):
+        base = baseline.get(key)
+        if value is None or not base:
+            continue
+
+        if key.endswith('_per_s'):
+            change = 1 - float(value) / base
+        else:
+            change = float(value) / base - 1
+
+        if change > tolerance:
+            regressions.append((key, base, value, change))
+
+    return regressions
+
+
+def format_value(key, value):
+    if value is None:
+        return '-'
+    if key.endswith('_rss_kb'):
+        return format_size(value * 1024, binary=True)
+    if isinstance(value, float):
+        return '%.3f' % value
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of plexiglas against a local fake Plex server')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run (default all: %s)'
+                                                      % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--files', type=int, default=20, help='Count of files to sync (default %(default)d)')
+    parser.add_argument('--part-size', default='8M', help='Size of every file (default %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Delay of every response of the server, seconds (default %(default)s)')
+    parser.add_argument('--bandwidth', default='0', help='Bandwidth of every download, 0 is unlimited '
+                                                         '(default %(default)s)')
+    parser.add_argument('--parallel-downloads', type=int, default=1)
+    parser.add_argument('--download-segments', type=int, default=1)
+    parser.add_argument('--download-backend', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--json', help='Save the results to the file')
+    parser.add_argument('--baseline', help='Compare the results with the previously saved ones')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative regression against the baseline (default %(default)s)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    child_argv = [a for a in sys.argv[1:] if a not in args.benchmarks]
+    args.part_size = parse_size(args.part_size, binary=True)
+    args.bandwidth = parse_size(args.bandwidth, binary=True)
+
+    if args.child:
+        run_child(args)
+        return
+
+    names = args.benchmarks or sorted(BENCHMARKS)
+    results = {}
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark %s' % name)
+
+        print('Running %s...' % name, file=sys.stderr)
+        results.update(run_benchmark(name, child_argv))
+
+    width = max(len(k) for k in results)
+    for key, value in sorted(results.items()):
+        print('%s  %s' % (key.ljust(width), format_value(key, value)))
+
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+
+        for key, base, value, change in regressions:
+            print('REGRESSION %s: %s -> %s (%+.0f%%)' % (key, format_value(key, base), format_value(key, value),
+                                                         change * 100), file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Queue of the acknowledgements of the mobile sync downloads (`PUT /sync/<client id>/item/<media id>/downloaded` on the
+server), so the downloads don't wait for a round trip to the server after every file.
+
+The acknowledgements are stored in the DB first, so none is lost if the process dies, and sent by a background thread
+in batches of `BATCH_SIZE`, reusing the connection to the server. A failed acknowledgement is retried with exponential
+backoff; the ones for the media removed from the server are dropped.
+"""
+
+import threading
+from itertools import groupby
+from operator import itemgetter
+from time import time
+
+from . import db, log, metrics
+
+BATCH_SIZE = 50
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+
+_flusher = None
+_lock = threading.Lock()
+
+
+def enqueue(machine_id, client_id, media_id):
+    """ Queues the acknowledgement, it's sent as soon as the flusher is started (see `start()`). Should be called
+        within `db.durable()`, as the flusher may read the row before the transaction is committed.
+    """
+    db.add_pending_ack(machine_id, client_id, media_id)
+
+    with _lock:
+        flusher = _flusher
+
+    if flusher is not None:
+        flusher.wake()
+
+
+def get_retry_delay(attempts):
+    return min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** min(attempts, 16))
+
+
+class AckFlusher(threading.Thread):
+    def __init__(self, plex, opts):
+        super(AckFlusher, self).__init__(name='plexiglas-acks')
+        self.daemon = True
+        self.plex = plex
+        self.opts = opts
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        """ Makes the thread to send the due acknowledgements and exit. """
+        self._stopped.set()
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                self.flush()
+                _, next_attempt_at = db.get_pending_acks_stats()
+            except Exception:
+                log.exception('Unable to send the download acknowledgements')
+                next_attempt_at = time() + RETRY_DELAY
+
+            if self._stopped.is_set():
+                break
+
+            self._wakeup.wait(max(0, next_attempt_at - time()) if next_attempt_at is not None else None)
+
+    def flush(self):
+        """ Sends all the due acknowledgements. """
+        while True:
+            rows = db.get_pending_acks(time(), BATCH_SIZE)
+            if not rows:
+                break
+
+            sent = []
+            postponed = []
+            for machine_id, group in groupby(rows, key=itemgetter('machine_id')):
+                self._send(machine_id, list(group), sent, postponed)
+
+            db.remove_pending_acks(sent)
+            db.postpone_pending_acks(postponed)
+            log.debug('Sent %d download acknowledgements, %d are postponed', len(sent), len(postponed))
+
+        metrics.set_value('plexiglas_pending_acks', db.get_pending_acks_stats()[0])
+
+    def _send(self, machine_id, rows, sent, postponed):
+        from plexapi import TIMEOUT
+        from requests import codes, exceptions
+        from .plex import get_server
+
+        try:
+            server = get_server(self.plex, machine_id, self.opts.resources_ttl)
+        except exceptions.RequestException:
+            log.debug('Unable to connect to server %s', machine_id, exc_info=True)
+            server = None
+
+        for row in rows:
+            if server is not None:
+                url = server.url('/sync/%s/item/%s/downloaded' % (row['client_id'], row['media_id']))
+                try:
+                    response = server._session.put(url, headers=server._headers(), timeout=TIMEOUT)
+                except exceptions.RequestException:
+                    # The server is unreachable, so don't try the rest of the batch
+                    log.debug('Unable to acknowledge media#%s', row['media_id'], exc_info=True)
+                    server = None
+                else:
+                    if response.status_code in (codes.ok, codes.created, codes.no_content):
+                        sent.append(row['id'])
+                        continue
+                    elif response.status_code == codes.not_found:
+                        log.debug('Media#%s is not found on server %s, dropping the acknowledgement',
+                                  row['media_id'], machine_id)
+                        sent.append(row['id'])
+                        continue
+
+                    log.debug('Unable to acknowledge media#%s: %d %s', row['media_id'], response.status_code,
+                              response.text)
+
+            postponed.append((row['id'], time() + get_retry_delay(row['attempts'])))
+
+
+def start(plex, opts):
+    """ Starts sending the queued acknowledgements in background, or updates the client of the running flusher. """
+    global _flusher
+
+    with _lock:
+        if _flusher is not None and _flusher.is_alive():
+            _flusher.plex = plex
+            _flusher.wake()
+            return
+
+        _flusher = AckFlusher(plex, opts)
+        _flusher.start()
+
+
+def stop():
+    """ Sends the due acknowledgements and stops the flusher, the postponed ones are left for the next run. """
+    global _flusher
+
+    with _lock:
+        flusher, _flusher = _flusher, None
+
+    if flusher is not None:
+        flusher.stop()
+        flusher.join()
@@ -0,0 +1,293 @@
+"""
+asyncio based download backend, enabled by `--download-backend asyncio`.
+
+All the transfers are performed by a single event loop running in a background thread, instead of a thread per
+download (and per segment). Requires Python 3.5+ and aiohttp, so the module is imported only when the backend is
+selected.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+
+import aiohttp
+from requests import exceptions
+
+from . import log, metrics
+from .content import MediaDownload, RangeNotSupported, _create_segmented_file, _load_segments_state, \
+    _save_segments_state, hash_file, preallocate, rate_limit_buckets, split_segments
+from .scheduler import DownloadScheduler
+from .token_bucket import create_bucket
+
+
+async def throttle(buckets, size):
+    for bucket in buckets:
+        delay = bucket.reserve(size)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def create_progress_bar(filename, total, initial):
+    from .tqdm_stub import tqdm
+
+    return tqdm(unit='B', unit_scale=True, total=total, desc=filename, initial=initial)
+
+
+def write_chunk(handle, chunk, hasher=None):
+    handle.write(chunk)
+    if hasher is not None:
+        hasher.update(chunk)
+
+
+async def download(session, url, token, fullpath, chunksize, buckets=(), prealloc=False, hasher=None):
+    """ Downloads the url to `fullpath` in a single stream, resuming the existing file, see `content.download`. All
+        the disk operations are performed in the loop's executor, so a slow disk doesn't stall the other transfers.
+    """
+    loop = asyncio.get_event_loop()
+    headers = {'X-Plex-Token': token}
+    if os.path.isfile(fullpath):
+        headers['Range'] = 'bytes=%d-' % os.path.getsize(fullpath)
+
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+
+        initial = 0
+        file_mode = 'wb'
+        if headers.get('Range') and response.status == 206:
+            initial = os.path.getsize(fullpath)
+            file_mode = 'ab'
+
+        content_length = response.content_length
+        bar = create_progress_bar(os.path.basename(fullpath), (content_length or 0) + initial, initial)
+
+        if hasher is not None and file_mode == 'ab':
+            await loop.run_in_executor(None, hash_file, fullpath, hasher, chunksize)
+
+        received = 0
+        handle = await loop.run_in_executor(None, open, fullpath, file_mode)
+        try:
+            if prealloc:
+                await loop.run_in_executor(None, preallocate, handle, initial, content_length or 0)
+
+            async for chunk in response.content.iter_chunked(chunksize):
+                await throttle(buckets, len(chunk))
+                await loop.run_in_executor(None, write_chunk, handle, chunk, hasher)
+                received += len(chunk)
+                metrics.add_downloaded(len(chunk))
+                bar.update(len(chunk))
+        finally:
+            await loop.run_in_executor(None, handle.close)
+
+        bar.close()
+
+    if content_length is not None and received != content_length:
+        raise exceptions.ChunkedEncodingError('Received %d bytes instead of %d for %s'
+                                              % (received, content_length, fullpath))
+
+
+async def download_segmented(session, url, token, fullpath, size, segments, min_segment_size, chunksize, buckets=(),
+                             prealloc=False, state_save_interval=16 * 1024 ** 2):
+    """ Downloads the url to `fullpath` using multiple ranged requests, see `content.download_segmented`. """
+    loop = asyncio.get_event_loop()
+    state_path = fullpath + '.segments'
+    lock = threading.Lock()
+
+    def load_state():
+        state = None
+        if os.path.isfile(fullpath) and os.path.getsize(fullpath) == size:
+            state = _load_segments_state(state_path, size)
+
+        if state is None:
+            state = split_segments(size, segments, min_segment_size)
+            _create_segmented_file(fullpath, state_path, size, state, prealloc)
+
+        return state
+
+    state = await loop.run_in_executor(None, load_state)
+    bar = create_progress_bar(os.path.basename(fullpath), size, sum(s[2] - s[0] for s in state))
+    failed = []
+
+    def save_state(handle, segment, position):
+        # The position is recorded only after the segment's own data is durable, see `content.download_segmented`;
+        # it's called from the executor, so the segments may save the state simultaneously
+        handle.flush()
+        os.fsync(handle.fileno())
+        with lock:
+            segment[2] = position
+            _save_segments_state(state_path, size, state)
+
+    async def fetch(segment):
+        position = segment[2]
+        headers = {'X-Plex-Token': token, 'Range': 'bytes=%d-%d' % (position, segment[1] - 1)}
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status != 206:
+                    raise RangeNotSupported('Unexpected response code %d for ranged request' % response.status)
+
+                handle = await loop.run_in_executor(None, open, fullpath, 'r+b')
+                try:
+                    await loop.run_in_executor(None, handle.seek, position)
+                    unsaved = 0
+                    async for chunk in response.content.iter_chunked(chunksize):
+                        if failed:
+                            break
+
+                        await throttle(buckets, len(chunk))
+                        chunk = chunk[:segment[1] - position]
+                        await loop.run_in_executor(None, write_chunk, handle, chunk)
+                        position += len(chunk)
+                        metrics.add_downloaded(len(chunk))
+                        unsaved += len(chunk)
+                        bar.update(len(chunk))
+
+                        if unsaved >= state_save_interval:
+                            await loop.run_in_executor(None, save_state, handle, segment, position)
+                            unsaved = 0
+
+                        if position >= segment[1]:
+                            break
+
+                    await loop.run_in_executor(None, save_state, handle, segment, position)
+                finally:
+                    await loop.run_in_executor(None, handle.close)
+        except BaseException:
+            failed.append(True)
+            raise
+
+    results = await asyncio.gather(*[fetch(s) for s in state if s[2] < s[1]], return_exceptions=True)
+    bar.close()
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    if any(s[2] < s[1] for s in state):
+        raise exceptions.ChunkedEncodingError('Segmented download of %s finished prematurely' % fullpath)
+
+    os.unlink(state_path)
+
+
+class AsyncDownloadScheduler(DownloadScheduler):
+    """
+    The scheduler running the downloads on an event loop in a background thread, up to `--parallel-downloads` at
+    once. The jobs are prepared and finished (the files are checked, hashed and renamed), and the received data is
+    written, in the loop's executor, so the disk operations don't block the transfers.
+    """
+
+    def __init__(self, plex, opts, disk_used=0):
+        super(AsyncDownloadScheduler, self).__init__(plex, opts, disk_used)
+        self._loop = None
+        self._loop_thread = None
+        self._semaphore = None
+        self._session = None
+        self._futures = []
+
+    def submit(self, job):
+        if not self._reserve(job):
+            return False
+
+        self._start_loop()
+        self._futures.append(asyncio.run_coroutine_threadsafe(self._run_async(job), self._loop))
+
+        return True
+
+    def _start_loop(self):
+        if self._loop is not None:
+            return
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name='plexiglas-download-loop')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    def _get_session(self):
+        if self._session is None:
+            from plexapi import TIMEOUT
+
+            self._semaphore = asyncio.Semaphore(self.workers)
+            connector = aiohttp.TCPConnector(limit=self.workers * max(1, self.opts.download_segments))
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=None, sock_read=TIMEOUT))
+
+        return self._session
+
+    async def _run_async(self, job):
+        session = self._get_session()
+        loop = asyncio.get_event_loop()
+        failed = True
+
+        try:
+            async with self._semaphore:
+                if self._exc_info is not None:
+                    # Some download has already failed, the error will be re-raised in join(); skip the rest
+                    return
+
+                task = MediaDownload(self.plex, job.sync_title, job.media, job.part, self.opts, job.callback,
+                                     job.max_allowed_size_diff_percent)
+                if await loop.run_in_executor(None, task.prepare):
+                    try:
+                        await self._transfer(session, task)
+                    except aiohttp.ClientResponseError as e:
+                        await loop.run_in_executor(None, task.transfer_failed)
+                        raise exceptions.HTTPError(e) from e
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        # The errors are re-raised by join(), so they are handled by cli.main like the ones of the
+                        # threads backend: the download is retried on the next iteration
+                        await loop.run_in_executor(None, task.transfer_failed)
+                        raise exceptions.ConnectionError(e) from e
+                    except BaseException:
+                        await loop.run_in_executor(None, task.transfer_failed)
+                        raise
+                    await loop.run_in_executor(None, task.transferred)
+
+                await loop.run_in_executor(None, task.finish)
+                failed = False
+        except BaseException:
+            log.debug('Download of %s failed', job.media.title, exc_info=True)
+            with self._lock:
+                if self._exc_info is None:
+                    self._exc_info = sys.exc_info()
+        finally:
+            self._release(job, failed)
+
+    async def _transfer(self, session, task):
+        opts = self.opts
+        fullpath = task.path_tmp
+
+        buckets = list(rate_limit_buckets(opts))
+        if opts.rate_limit_per_download:
+            buckets.append(create_bucket(opts.rate_limit_per_download))
+
+        if task.segmented:
+            try:
+                await download_segmented(session, task.url, task.token, fullpath, task.part.size,
+                                         opts.download_segments, 16 * 1024 ** 2, opts.download_chunk_size, buckets,
+                                         opts.preallocate)
+            except RangeNotSupported:
+                task.range_not_supported()
+
+        if not task.segmented:
+            await download(session, task.url, task.token, fullpath, opts.download_chunk_size, buckets,
+                           opts.preallocate, task.hasher)
+            task.hashed = True
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def join(self):
+        for future in self._futures:
+            future.result()
+        self._futures = []
+
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._close_session(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+            self._loop = None
+            self._loop_thread = None
+
+        super(AsyncDownloadScheduler, self).join()
@@ -3,7 +3,7 @@ import argparse
 import logging
 import platform
 import sys
-from time import sleep
+from time import sleep, time
 import humanfriendly as hf
 
 from . import log, keyring, set_keyring, __version__
@@ -12,6 +12,7 @@ from .plugin import get_all_plugins
 
 def process_opts(opts):
     from .content import makedirs
+    from .planner import parse_sync_weights
 
     init_logging(opts)
 
@@ -58,25 +59,48 @@ def process_opts(opts):
             print('Directory "%s" should be writable' % opts.destination)
             exit(1)
 
+    if opts.metrics_textfile:
+        opts.metrics_textfile = os.path.abspath(os.path.expanduser(opts.metrics_textfile))
+
+    if opts.profile_dir:
+        opts.profile_dir = os.path.abspath(os.path.expanduser(opts.profile_dir))
+        makedirs(opts.profile_dir, exist_ok=True)
+
     os.chdir(opts.destination)
 
+    opts.limit_disk_usage_percent = None
     if opts.limit_disk_usage:
         if '%' in opts.limit_disk_usage:
             tokens = hf.tokenize(opts.limit_disk_usage)
             if len(tokens) == 2 and tokens[1] == '%' and tokens[0] <= 100:
-                from .content import get_total_disk_space
-
-                total_space = get_total_disk_space(opts.destination)
-                opts.limit_disk_usage = int(total_space / 100 * int(tokens[0]))
-                log.info('Setting disk usage limit to %s', hf.format_size(opts.limit_disk_usage, binary=True))
+                opts.limit_disk_usage_percent = int(tokens[0])
+                opts.limit_disk_usage = None
+                update_disk_limit(opts)
             else:
                 print('Unexpected disk usage limit')
                 exit(1)
         else:
             opts.limit_disk_usage = hf.parse_size(opts.limit_disk_usage, binary=True)
 
-    if opts.rate_limit and not opts.rate_limit.isdigit():
-        opts.rate_limit = hf.parse_size(opts.rate_limit, binary=True)
+    opts.segmented_download_min_size = hf.parse_size(opts.segmented_download_min_size, binary=True)
+    opts.download_chunk_size = hf.parse_size(opts.download_chunk_size, binary=True)
+    opts.metadata_cache_size = hf.parse_size(opts.metadata_cache_size, binary=True)
+
+    try:
+        opts.sync_weight = parse_sync_weights(opts.sync_weight)
+    except ValueError:
+        print('Unexpected sync weight, it should be provided as TITLE=WEIGHT')
+        exit(1)
+
+    opts.rate_limit = parse_rate_limit(opts.rate_limit)
+    opts.rate_limit_per_download = parse_rate_limit(opts.rate_limit_per_download)
+
+    if opts.download_backend == 'asyncio':
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError:
+            print('asyncio download backend requires Python 3.5+ and aiohttp package installed')
+            exit(1)
 
     for plugin in get_all_plugins():
         if hasattr(plugin, 'process_options'):
@@ -84,6 +108,35 @@ def process_opts(opts):
             plugin.process_options(opts)
 
 
+def update_disk_limit(opts):
+    """ Recalculates the disk usage limit provided in percents, as the size of the disk may change while running. """
+    from .content import get_total_disk_space
+
+    if not opts.limit_disk_usage_percent:
+        return
+
+    limit = int(get_total_disk_space(opts.destination) / 100 * opts.limit_disk_usage_percent)
+    if limit != opts.limit_disk_usage:
+        opts.limit_disk_usage = limit
+        log.info('Setting disk usage limit to %s', hf.format_size(opts.limit_disk_usage, binary=True))
+
+
+def parse_rate_limit(value):
+    from .token_bucket import RateSchedule
+
+    if not value:
+        return None
+
+    try:
+        if '=' in value:
+            return RateSchedule.parse(value)
+        else:
+            return hf.parse_size(value, binary=True)
+    except (ValueError, hf.InvalidSize):
+        print('Unexpected rate limit %s' % value)
+        exit(1)
+
+
 def init_logging(opts):
     log.propagate = False
 
@@ -141,6 +194,34 @@ def parse_arguments():
                    action='store_true')
     group.add_argument('--delay', help='Delay in seconds between iterations (only with --loop, default %(default)d)',
                        default=60, type=int, metavar='int')
+    group.add_argument('--watch-events', help='Start the next iteration as soon as something has changed on the '
+                                              'servers or in the sync list, processing only the affected syncs, '
+                                              'instead of sleeping for --delay seconds (only with --loop)',
+                       action='store_true', default=False)
+    group.add_argument('--full-sync-interval', help='How often to check everything when watching the events, in '
+                                                    'seconds (default %(default)d)',
+                       default=3600, type=int, metavar='int')
+    group.add_argument('--events-debounce', help='Delay in seconds between the first event and the iteration, to '
+                                                 'handle a bunch of events at once (default %(default)d)',
+                       default=10, type=int, metavar='int')
+    group.add_argument('--sync-list-poll-interval', help='How often to check the sync list on plex.tv for changes '
+                                                         'when watching the events, in seconds, 0 disables it '
+                                                         '(default %(default)d)',
+                       default=60, type=int, metavar='int')
+    group.add_argument('--resources-ttl', help='How long (in seconds) to use the cached list of servers available for '
+                                               'your account (only with --loop, default %(default)d)',
+                       default=3600, type=int, metavar='int')
+    group.add_argument('--metadata-cache-ttl', help='How long (in seconds) to use cached responses of Plex servers '
+                                                    'without checking them, responses with ETag or Last-Modified '
+                                                    'are revalidated afterwards (default %(default)d)',
+                       default=0, type=int, metavar='int')
+    group.add_argument('--metadata-cache-size', help='Maximal size of cached Plex servers responses, 0 disables the '
+                                                     'cache (default %(default)s)', default='16M')
+    group.add_argument('--profile', help='Log wall time, network traffic and count of DB queries of every phase of '
+                                         'every iteration', action='store_true', default=False)
+    group.add_argument('--profile-dir', help='Profile every iteration with cProfile and save the results as .pstats '
+                                             'files to the directory (only the main thread is profiled, implies '
+                                             '--profile)', default=None)
     group.add_argument('--debug', help='Enable debug logging', action='store_true', default=False)
     group.add_argument('-v', '--verbose', help='Enable logging from plexapi', action='store_true', default=False)
     group.add_argument('-i', '--insecure', help='Store your password with minimal encryption, without requiring'
@@ -148,14 +229,59 @@ def parse_arguments():
                                                 'devices like WD My Passport Wireless Pro)',
                        default=False, action='store_true')
 
+    group = parser.add_argument_group('Metrics', 'Metrics in Prometheus format')
+    group.add_argument('--metrics-port', help='Serve the metrics over HTTP on the port', type=int, metavar='int',
+                       default=None)
+    group.add_argument('--metrics-address', help='Address to serve the metrics on (default %(default)s)',
+                       default='127.0.0.1')
+    group.add_argument('--metrics-textfile', help='Write the metrics to the file after every iteration, e.g. for '
+                                                  'node_exporter\'s textfile collector', default=None)
+
     group = parser.add_argument_group('Downloading', 'Download settings')
     group.add_argument('-d', '--destination', help='Download destination (default "%(default)s")', default=os.getcwd())
     group.add_argument('-w', '--mark-watched', help='Mark missing media as watched', action='store_true',
                        default=False)
     group.add_argument('-s', '--limit-disk-usage', help='Limit total downloaded files size (eg 1G, 100M, 10%%)')
+    group.add_argument('--disk-usage-source', help='What to check against --limit-disk-usage: the size of all the '
+                                                   'files within the destination directory (including partial '
+                                                   'downloads and the files added by you), or the size of the '
+                                                   'downloaded files recorded in the DB (default %(default)s)',
+                       choices=['files', 'db'], default='files')
+    group.add_argument('--scan-concurrency', help='Count of directories to check simultaneously when looking for the '
+                                                  'changes within the destination directory (default %(default)d)',
+                       default=4, type=int, metavar='int')
     group.add_argument('-r', '--resume-downloads', help='Allow to resume downloads (the result file may be broken)',
                        action='store_true', default=False)
-    group.add_argument('--rate-limit', help='Limit bandwidth usage per second (e.g. 1M, 100K)')
+    group.add_argument('--rate-limit', help='Limit bandwidth usage per second for all the downloads altogether '
+                                            '(e.g. 1M, 100K or a schedule 22:00-07:00=unlimited,07:00-22:00=2M)')
+    group.add_argument('--rate-limit-per-download', help='Limit bandwidth usage per second for every single file '
+                                                         '(e.g. 1M, 100K or a schedule like for --rate-limit)')
+    group.add_argument('--download-segments', help='Download big files using several simultaneous connections, each '
+                                                   'fetching its own part of the file (default %(default)d)',
+                       default=1, type=int, metavar='int')
+    group.add_argument('--segmented-download-min-size', help='Minimal size of the file to be downloaded in segments '
+                                                             '(default %(default)s)', default='256M')
+    group.add_argument('--download-chunk-size', help='Size of a single read from the network (default %(default)s)',
+                       default='1M')
+    group.add_argument('--preallocate', help='Reserve disk space for a file before downloading it, reduces '
+                                             'fragmentation on some filesystems', action='store_true', default=False)
+    group.add_argument('--checksum', help='Calculate checksum of every downloaded file while downloading it and store '
+                                          'it in the DB (segmented downloads are hashed after completion)',
+                       choices=['md5', 'sha1', 'sha256'], default=None)
+    group.add_argument('--download-backend', help='How to perform the downloads: a thread per download and segment, '
+                                                  'or a single asyncio event loop, requires aiohttp '
+                                                  '(default %(default)s)',
+                       choices=['threads', 'asyncio'], default='threads')
+    group.add_argument('--parallel-downloads', help='Count of files to download simultaneously (default %(default)d)',
+                       default=1, type=int, metavar='int')
+    group.add_argument('--download-order', help='Priority of the files to download when not everything fits into the '
+                                                'disk limits: as they are returned by the server, oldest unwatched '
+                                                'first or smallest first (default %(default)s)',
+                       choices=['server', 'oldest', 'smallest'], default='server')
+    group.add_argument('--sync-weight', help='Weight of the files from the sync (by its title, i.e. the directory '
+                                             'name) when choosing the files to fit into the disk limits, 1 by '
+                                             'default, may be used multiple times', action='append', default=[],
+                       metavar='TITLE=WEIGHT')
     group.add_argument('--skip', help='Name of the file (including parent directory, which is the sync name) to skip, '
                                       'may be used multiple times', action='append', default=[])
     group.add_argument('--subdir', help='Place movies files into subdirectories, so you would be able to add here some '
@@ -191,9 +317,13 @@ def confirm(prompt, default=False):
 
 
 def main():
-    from .plex import get_plex_client
+    from .plex import get_connected_servers, get_metadata_cache, get_plex_client, reset_connections
     from .content import cleanup
-    from . import db
+    from .http_cache import log_stats as log_cache_stats
+    from .planner import execute_plans
+    from .profiling import IterationProfiler
+    from .reconcile import get_disk_used, reconcile
+    from . import acks, db, inventory, metrics, transcodes
     from requests import exceptions
 
     opts = parse_arguments()
@@ -214,9 +344,19 @@ def main():
         get_plex_client(opts)
         exit(0)
 
+    if opts.metrics_port:
+        metrics.start_http_server(opts.metrics_port, opts.metrics_address)
+
     log.info('Using myplex with username %s', opts.username)
 
     last_reported_du = None
+    iteration = 0
+    plex = None
+    trigger = None
+    watcher = None
+    if opts.loop and opts.watch_events:
+        from .events import EventWatcher
+        watcher = EventWatcher(opts)
 
     stop = False
     while not stop:
@@ -226,6 +366,8 @@ def main():
             if stop:
                 log.error('Destination directory does not exists')
                 exit(1)
+            db.close()
+            inventory.reset()
             log.debug('Destination directory is not found, probably external storage was disconnected, going to sleep')
             sleep(int(opts.delay))
             continue
@@ -237,26 +379,78 @@ def main():
                 last_reported_du = disk_used_hf
                 log.info('Currently used (according to DB): %s', disk_used_hf)
 
+            update_disk_limit(opts)
+            iteration += 1
+            metrics.start_iteration()
+            profiler = IterationProfiler(opts.profile, opts.profile_dir, iteration)
             try:
                 try:
-                    plex = get_plex_client(opts)
-                    for plugin in get_all_plugins():
-                        if hasattr(plugin, 'sync'):
-                            log.debug('Running sync on %s', plugin.name)
-                            required_media = plugin.sync(plex, opts)
-                            cleanup(plex, plugin.name, required_media, opts)
+                    with profiler:
+                        with metrics.phase('auth'), profiler.phase('auth'):
+                            plex = get_plex_client(opts)
+                        acks.start(plex, opts)
+                        plans = []
+                        with db.transaction():
+                            with metrics.phase('inventory'), profiler.phase('inventory'):
+                                inventory.refresh(opts.destination, opts.scan_concurrency)
+                                reconcile(opts)
+
+                            for plugin in get_all_plugins():
+                                if hasattr(plugin, 'plan'):
+                                    log.debug('Running plan on %s', plugin.name)
+                                    with metrics.phase('metadata'), profiler.phase('plan ' + plugin.name):
+                                        plans.append((plugin, plugin.plan(plex, opts, trigger)))
+                                elif hasattr(plugin, 'sync'):
+                                    log.debug('Running sync on %s', plugin.name)
+                                    with metrics.phase('sync'), profiler.phase('sync ' + plugin.name):
+                                        required_media = plugin.sync(plex, opts)
+                                    with metrics.phase('cleanup'), profiler.phase('cleanup ' + plugin.name):
+                                        cleanup(plex, plugin.name, required_media, opts)
+
+                            with metrics.phase('download'), profiler.phase('download'):
+                                execute_plans(plex, opts, [p for _, p in plans], get_disk_used(opts))
+
+                            with metrics.phase('cleanup'):
+                                for plugin, plan in plans:
+                                    with profiler.phase('cleanup ' + plugin.name):
+                                        cleanup(plex, plugin.name, plan.required_media, opts)
+
+                    metrics.set_value('plexiglas_last_iteration_timestamp_seconds', time())
+                    if watcher is not None:
+                        watcher.subscribe(get_connected_servers())
                 except exceptions.RequestException:
                     if stop:
                         raise
                     else:
+                        metrics.inc('plexiglas_iteration_errors_total')
+                        if watcher is not None:
+                            # The changes of the failed iteration may be lost, so check everything the next time
+                            watcher.request_full(opts.delay)
+                        reset_connections()
                         log.exception('Got exception from RequestException family, it shouldn`t be anything serious')
             except BaseException:
+                metrics.inc('plexiglas_iteration_errors_total')
                 log.exception('Unexpected error')
                 raise
-
-        if not stop:
+            finally:
+                metrics.inc('plexiglas_iterations_total')
+                metrics.update_storage(opts)
+                if opts.metrics_textfile:
+                    metrics.write_textfile(opts.metrics_textfile)
+
+        metadata_cache = get_metadata_cache()
+        if metadata_cache is not None:
+            log_cache_stats(metadata_cache)
+
+        if not stop and watcher is not None:
+            log.debug('Waiting for changes, at most %d seconds', opts.full_sync_interval)
+            trigger = watcher.wait(plex)
+            log.debug('Starting iteration for %r', trigger)
+        elif not stop:
             log.debug('Going to sleep for %d seconds', opts.delay)
-            sleep(int(opts.delay))
+            transcodes.wait(opts, int(opts.delay))
+
+    acks.stop()
 
 
 if __name__ == '__main__':
@@ -1,34 +1,81 @@
+from collections import namedtuple
 from humanfriendly import format_size
 from plexapi.exceptions import BadRequest
+import hashlib
 import platform
+import re
 
-from . import db, log
+from . import db, log, metrics
 import os
-from .token_bucket import rate_limit as limit_bandwidth
+from .plex import get_server
+from .token_bucket import create_bucket, rate_limit as limit_bandwidth, shared_bucket
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+CleanupReport = namedtuple('CleanupReport', ['removed', 'missing'])
+
+
+def sync_dirname(sync_title):
+    """ Returns the directory name for the sync, everything after `#` in the title is ignored. """
+    if '#' in sync_title:
+        sync_title, _ = sync_title.split('#', 1)
+        sync_title = sync_title.strip()
+
+    return sanitize_filename(sync_title, True)
+
+
+def list_files(path):
+    """ Returns the set of the files names within the directory, or an empty set if the directory doesn't exist. """
+    try:
+        if hasattr(os, 'scandir'):
+            return set(entry.name for entry in os.scandir(path) if entry.is_file())
+        else:
+            return set(os.listdir(path))
+    except OSError:
+        return set()
+
+
+def get_media_dir(opts, sync_dir, media_type, media_filename):
+    """ Returns the directory of a downloaded file by its sync directory name and its (sanitized) file name. """
+    if media_type == 'movie' and opts.subdir:
+        return os.path.join(opts.destination, sync_dir, os.path.splitext(media_filename)[0])
+
+    return os.path.join(opts.destination, sync_dir)
 
 
 def cleanup(plex, sync_type, required_media, opts):
+    """
+    Removes the files which are not required anymore and forgets about the files, which are missing on the disk.
+
+    :return: paths of the removed files and of the files which were not found
+    :rtype: CleanupReport
+    """
+    from .inventory import get_inventory
+
+    inventory = get_inventory(opts.destination)
+    required_media = set(required_media)
+    dirnames = {}
+    files = {}
+    stale_ids = []
+    report = CleanupReport([], [])
+
     for row in db.get_all_downloaded(sync_type):
-        sync_title = row['sync_title']
-        if '#' in sync_title:
-            sync_title, _ = sync_title.split('#', 1)
-            sync_title = sync_title.strip()
+        if row['sync_title'] not in dirnames:
+            dirnames[row['sync_title']] = sync_dirname(row['sync_title'])
 
-        sync_title = sanitize_filename(sync_title, True)
         media_filename = sanitize_filename(row['media_filename'])
+        media_dir = get_media_dir(opts, dirnames[row['sync_title']], row['media_type'], media_filename)
+        media_path = os.path.join(media_dir, media_filename)
+
+        if media_dir not in files:
+            files[media_dir] = inventory.list_files(media_dir)
+        is_file = media_filename in files[media_dir]
 
-        if row['media_type'] == 'movie' and opts.subdir:
-            media_path = os.path.join(opts.destination, sync_title, os.path.splitext(media_filename)[0], media_filename)
-        else:
-            media_path = os.path.join(opts.destination, sync_title, media_filename)
         if (row['machine_id'], row['media_id']) in required_media:
-            if not os.path.isfile(media_path):
+            if not is_file:
                 if opts.mark_watched:
-                    conn = None
-                    for res in plex.resources():
-                        if res.clientIdentifier == row['machine_id']:
-                            conn = res.connect()
-                            break
+                    conn = get_server(plex, row['machine_id'], opts.resources_ttl)
 
                     if conn:
                         log.info('File %s not found, marking media as watched', media_path)
@@ -39,17 +86,29 @@ def cleanup(plex, sync_type, required_media, opts):
                         except BadRequest as e:
                             if 'not_found' not in str(e):
                                 raise
-                        db.remove_downloaded(row['machine_id'], sync_type, row['sync_id'], row['media_id'])
+                        stale_ids.append(row['id'])
+                        report.missing.append(media_path)
                     else:
                         log.error('Unable to find server %s', row['machine_id'])
                 else:
                     log.error('File not found %s, removing it from the DB', media_path)
-                    db.remove_downloaded(row['machine_id'], sync_type, row['sync_id'], row['media_id'])
+                    stale_ids.append(row['id'])
+                    report.missing.append(media_path)
         else:
             log.info('File is not required anymore %s', media_path)
-            if os.path.isfile(media_path):
-                os.unlink(media_path)
-            db.remove_downloaded(row['machine_id'], sync_type, row['sync_id'], row['media_id'])
+            if is_file:
+                inventory.unlink(media_path)
+            stale_ids.append(row['id'])
+            report.removed.append(media_path)
+
+    if stale_ids:
+        with db.transaction():
+            db.remove_downloaded_items(stale_ids)
+
+        log.info('Cleanup removed %d not required and %d missing files from the DB', len(report.removed),
+                 len(report.missing))
+
+    return report
 
 
 def pretty_filename(media, part):
@@ -111,8 +170,78 @@ def makedirs(name, mode=0o777, exist_ok=False):
             raise
 
 
-def download(url, token, session, filename, savepath=None, chunksize=4024,
-             showstatus=False, rate_limit=None):
+def iter_response(response, chunksize):
+    """ Yields the response body by chunks. When possible the data is read straight into a reusable buffer, without
+        allocating a new object for every chunk, so the yielded memoryview is valid only until the next iteration.
+    """
+    fp = getattr(response.raw, '_fp', None)
+    if response.headers.get('content-encoding') or not hasattr(fp, 'readinto'):
+        for chunk in response.iter_content(chunk_size=chunksize):
+            yield chunk
+        return
+
+    import socket
+    from requests import exceptions
+    from six.moves import http_client
+
+    buf = bytearray(chunksize)
+    view = memoryview(buf)
+    while True:
+        # The same exceptions as `iter_content()` raises, so a network error is handled as usual by the caller
+        try:
+            size = fp.readinto(buf)
+        except http_client.HTTPException as e:
+            raise exceptions.ChunkedEncodingError(e)
+        except (socket.timeout, socket.error) as e:
+            raise exceptions.ConnectionError(e)
+
+        if not size:
+            break
+        yield view[:size]
+
+
+def preallocate(handle, offset, length):
+    """ Reserves disk space for the file, to reduce fragmentation. On Linux the file size is kept as is, elsewhere
+        `posix_fallocate` is used only when the file is already of the required size, because the size of a `.part`
+        file tells whether the download is complete. Errors are ignored, as not every filesystem supports this.
+    """
+    if length <= 0:
+        return
+
+    if platform.system() == 'Linux':
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+            fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            falloc_fl_keep_size = 1
+            if fallocate(handle.fileno(), falloc_fl_keep_size, offset, length) != 0:
+                log.debug('fallocate() failed with errno %d', ctypes.get_errno())
+        except (OSError, AttributeError):
+            log.debug('Unable to preallocate space', exc_info=True)
+    elif hasattr(os, 'posix_fallocate') and os.fstat(handle.fileno()).st_size >= offset + length:
+        try:
+            os.posix_fallocate(handle.fileno(), offset, length)
+        except OSError:
+            log.debug('Unable to preallocate space', exc_info=True)
+
+
+def hash_file(path, hasher, chunksize=DEFAULT_CHUNK_SIZE):
+    """ Feeds the file contents to the hasher. """
+    with open(path, 'rb') as handle:
+        while True:
+            chunk = handle.read(chunksize)
+            if not chunk:
+                break
+            hasher.update(chunk)
+
+    return hasher
+
+
+def download(url, token, session, filename, savepath=None, chunksize=DEFAULT_CHUNK_SIZE,
+             showstatus=False, rate_limit=None, buckets=(), prealloc=False, hasher=None):
     """ Helper to download a thumb, videofile or other media item. Returns the local
         path to the downloaded file.
 
@@ -124,13 +253,18 @@ def download(url, token, session, filename, savepath=None, chunksize=4024,
             savepath (str): Defaults to current working dir.
             chunksize (int): What chunksize read/write at the time.
             showstatus(bool): Display a progressbar.
+            rate_limit (int|RateSchedule): Bandwidth limit for this download.
+            buckets (list): Token buckets shared with other downloads.
+            prealloc (bool): Reserve disk space for the whole file before writing.
+            hasher (hashlib.hash): Hash object to be updated with the file contents while downloading, when the
+                download is resumed the existing part of the file is hashed first.
 
         Example:
             >>> download(a_episode.getStreamURL(), a_episode.location)
             /path/to/file
     """
 
-    from requests import codes
+    from requests import codes, exceptions
     from plexapi import TIMEOUT
 
     # make sure the savepath directory exists
@@ -173,94 +307,436 @@ def download(url, token, session, filename, savepath=None, chunksize=4024,
 
         bar = tqdm(unit='B', unit_scale=True, total=total, desc=filename, initial=initial)
 
-    if rate_limit and 0 < rate_limit < chunksize:
-        chunksize = rate_limit
+    if hasher is not None and file_mode == 'ab':
+        hash_file(fullpath, hasher, chunksize)
+
+    content_length = response.headers.get('content-length')
+    received = 0
 
     with open(fullpath, file_mode) as handle:
-        iter_content = response.iter_content(chunk_size=chunksize)
+        if prealloc:
+            preallocate(handle, handle.tell(), int(content_length or 0))
+
+        iter_content = iter_response(response, chunksize)
 
-        if rate_limit and rate_limit > 0:
-            iter_content = limit_bandwidth(iter_content, rate_limit)
+        if rate_limit or buckets:
+            iter_content = limit_bandwidth(iter_content, rate_limit, buckets=buckets)
 
         for chunk in iter_content:
             handle.write(chunk)
+            received += len(chunk)
+            metrics.add_downloaded(len(chunk))
+            if hasher is not None:
+                hasher.update(chunk)
             if bar is not None:
                 bar.update(len(chunk))
 
+    response.close()
+
+    if content_length is not None and received != int(content_length):
+        raise exceptions.ChunkedEncodingError('Received %d bytes instead of %s for %s'
+                                              % (received, content_length, filename))
+
     if bar:
         bar.close()
 
     return fullpath
 
 
-def sanitize_filename(filename, allow_dir_separator=False):
-    if allow_dir_separator:
-        filename = os.path.normpath(filename)
-    else:
-        filename = filename.replace('/', '_').replace('\\', '_')
+class RangeNotSupported(Exception):
+    pass
 
-    for c in ['?', ';', ':', '+', '<', '>', '|', '*', '"']:
-        filename = filename.replace(c, '_')
-    for c in range(0, 31):
-        filename = filename.replace(chr(c), '_')
-    old_file_name = filename
-    filename.replace('__', '_')
-    while old_file_name != filename:
-        old_file_name = filename
-        filename.replace('__', '_')
-    return filename
 
+def _load_segments_state(state_path, size):
+    import json
 
-def download_media(plex, sync_title, media, part, opts, downloaded_callback, max_allowed_size_diff_percent=0):
-    log.debug('Checking media#%d %s', media.ratingKey, media.title)
-    filename = sanitize_filename(pretty_filename(media, part))
-    filename_tmp = filename + '.part'
+    try:
+        with open(state_path) as handle:
+            state = json.load(handle)
+    except (IOError, OSError, ValueError):
+        return None
 
-    if '#' in sync_title:
-        sync_title, _ = sync_title.split('#', 1)
-        sync_title = sync_title.strip()
+    if state.get('size') != size:
+        return None
+
+    return [list(s) for s in state['segments']]
 
-    savepath = os.path.join(opts.destination, sanitize_filename(sync_title, True))
 
-    if os.sep.join(os.path.join(savepath, filename).split(os.sep)[-2:]) in opts.skip:
-        log.info('Skipping file %s from %s due to cli arguments', filename, savepath)
+def _fsync_dir(path):
+    """ Makes the renames within the directory durable, not supported on Windows. """
+    if platform.system() == 'Windows':
         return
 
-    if media.TYPE == 'movie' and opts.subdir:
-        savepath = os.path.join(savepath, sanitize_filename(os.path.splitext(filename)[0]))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _save_segments_state(state_path, size, segments):
+    import json
+
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as handle:
+        json.dump({'size': size, 'segments': segments}, handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    if platform.system() == 'Windows' and os.path.exists(state_path):
+        os.unlink(state_path)
+    os.rename(tmp_path, state_path)
+    _fsync_dir(os.path.dirname(os.path.abspath(state_path)))
+
+
+def _create_segmented_file(fullpath, state_path, size, segments, prealloc=False):
+    """ Creates the `.part` file of the full size for a segmented download. The state is made durable first: a
+        `.part` file of the full size without the state is considered downloaded completely by `MediaDownload`.
+    """
+    _save_segments_state(state_path, size, segments)
+    with open(fullpath, 'wb') as handle:
+        handle.truncate(size)
+        if prealloc:
+            preallocate(handle, 0, size)
+
+
+def split_segments(size, segments, min_segment_size):
+    """ Splits `size` bytes into at most `segments` ranges, not smaller than `min_segment_size` (except the last one).
+        Each range is represented as [start, end, position], where `end` is exclusive and `position` is the offset
+        of the first byte which is not downloaded yet.
+    """
+    count = max(1, min(segments, size // max(1, min_segment_size)))
+    segment_size = size // count
+    ret = []
+    for i in range(count):
+        start = i * segment_size
+        end = size if i == count - 1 else start + segment_size
+        ret.append([start, end, start])
+    return ret
+
+
+def download_segmented(url, token, session, filename, size, savepath=None, segments=4, min_segment_size=16 * 1024 ** 2,
+                       chunksize=DEFAULT_CHUNK_SIZE, showstatus=False, rate_limit=None, buckets=(),
+                       state_save_interval=16 * 1024 ** 2, prealloc=False):
+    """ Downloads the file using multiple simultaneous connections, each of them fetches its own byte range and
+        writes it to the preallocated file. Progress of every segment is stored in `<filename>.segments` file, so an
+        interrupted download is resumed by requesting only the missing ranges. The state file is removed once the
+        download is complete.
 
-    part_key = part.key
-    if part.decision == 'directplay':
-        part_key = '/' + '/'.join(part_key.split('/')[3:]) + '?download=1'
-    url = part._server.url(part_key)
-    log.info('Downloading %s to %s, file size is %s', filename, savepath, format_size(part.size, binary=True))
+        Parameters:
+            url (str): URL where the content be reached.
+            token (str): Plex auth token to include in headers.
+            filename (str): Name of the file to save the content to.
+            size (int): Expected size of the file.
+            savepath (str): Defaults to current working dir.
+            segments (int): Maximal count of simultaneous connections.
+            min_segment_size (int): The file wouldn't be split into ranges smaller than this.
+            chunksize (int): What chunksize read/write at the time.
+            showstatus(bool): Display a progressbar.
+            rate_limit (int|RateSchedule): Bandwidth limit for all the segments altogether.
+            buckets (list): Token buckets shared with other downloads.
+            prealloc (bool): Reserve disk space for the whole file, instead of creating a sparse one.
+
+        Raises:
+            RangeNotSupported: when the server ignores `Range` header.
+    """
+
+    import threading
+    from requests import codes, exceptions
+    from plexapi import TIMEOUT
+
+    savepath = savepath or os.getcwd()
     makedirs(savepath, exist_ok=True)
+    filename = os.path.basename(filename)
+    fullpath = os.path.join(savepath, filename)
+    state_path = fullpath + '.segments'
+
+    state = None
+    if os.path.isfile(fullpath) and os.path.getsize(fullpath) == size:
+        state = _load_segments_state(state_path, size)
+
+    if state is None:
+        state = split_segments(size, segments, min_segment_size)
+        _create_segmented_file(fullpath, state_path, size, state, prealloc)
+
+    pending = [s for s in state if s[2] < s[1]]
+    lock = threading.Lock()
+    failed = threading.Event()
+    errors = []
+
+    bar = None
+    if showstatus:
+        from .tqdm_stub import tqdm
+
+        initial = sum(s[2] - s[0] for s in state)
+        bar = tqdm(unit='B', unit_scale=True, total=size, desc=filename, initial=initial)
+
+    buckets = list(buckets)
+    if rate_limit:
+        buckets.append(create_bucket(rate_limit))
+
+    def save_state(handle, segment, position):
+        """ Makes the data of the segment durable, and only then records its position, under the lock, so the state
+            file never covers the bytes still sitting in a buffer of some other segment.
+        """
+        handle.flush()
+        os.fsync(handle.fileno())
+        with lock:
+            segment[2] = position
+            _save_segments_state(state_path, size, state)
+
+    def fetch(segment):
+        # segment[2] is the durable position, which is saved into the state file; position is the written one
+        position = segment[2]
+        try:
+            headers = {'X-Plex-Token': token, 'Range': 'bytes=%d-%d' % (position, segment[1] - 1)}
+            response = session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+            if response.status_code != codes.partial_content:
+                response.close()
+                raise RangeNotSupported('Unexpected response code %d for ranged request' % response.status_code)
+
+            with open(fullpath, 'r+b') as handle:
+                handle.seek(position)
+                iter_content = iter_response(response, chunksize)
+
+                if buckets:
+                    iter_content = limit_bandwidth(iter_content, buckets=buckets)
+
+                unsaved = 0
+                for chunk in iter_content:
+                    if failed.is_set():
+                        break
+
+                    chunk = chunk[:segment[1] - position]
+                    handle.write(chunk)
+                    position += len(chunk)
+                    metrics.add_downloaded(len(chunk))
+                    unsaved += len(chunk)
+
+                    if bar is not None:
+                        with lock:
+                            bar.update(len(chunk))
+
+                    if unsaved >= state_save_interval:
+                        save_state(handle, segment, position)
+                        unsaved = 0
+
+                    if position >= segment[1]:
+                        break
+
+                save_state(handle, segment, position)
+            response.close()
+        except BaseException as e:
+            failed.set()
+            errors.append(e)
+
+    threads = []
+    for segment in pending:
+        t = threading.Thread(target=fetch, args=(segment, ))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    if bar:
+        bar.close()
+
+    if errors:
+        raise errors[0]
 
-    path = os.path.join(savepath, filename)
-    path_tmp = os.path.join(savepath, filename_tmp)
+    if any(s[2] < s[1] for s in state):
+        raise exceptions.ChunkedEncodingError('Segmented download of %s finished prematurely' % filename)
 
-    if not opts.resume_downloads and os.path.isfile(path_tmp) and os.path.getsize(path_tmp) != part.size:
-        os.unlink(path_tmp)
+    os.unlink(state_path)
+
+    return fullpath
+
+
+_forbidden_chars = re.compile('[?;:+<>|*"\x00-\x1e]')
 
-    if os.path.isfile(path_tmp) and os.path.getsize(path_tmp) > part.size:
-        log.error('File "%s" has an unexpected size (actual: %d, expected: %d), removing it', path_tmp,
-                  os.path.getsize(path_tmp), part.size)
-        os.unlink(path_tmp)
 
-    if not os.path.isfile(path_tmp) or os.path.getsize(path_tmp) != part.size:
+def sanitize_filename(filename, allow_dir_separator=False):
+    if allow_dir_separator:
+        filename = os.path.normpath(filename)
+    else:
+        filename = filename.replace('/', '_').replace('\\', '_')
+
+    return _forbidden_chars.sub('_', filename)
+
+
+def rate_limit_buckets(opts):
+    """ Returns token buckets shared by all the downloads. """
+    if opts.rate_limit:
+        return [shared_bucket(opts.rate_limit)]
+    return []
+
+
+class MediaDownload(object):
+    """ Download of a single media part, split into steps, so the transfer itself could be performed by different
+        backends: `prepare()` checks what is already on the disk and returns True if the file has to be transferred,
+        `transfer()` downloads it and `finish()` verifies the result, marks it as downloaded and renames the `.part`
+        file.
+    """
+
+    def __init__(self, plex, sync_title, media, part, opts, downloaded_callback, max_allowed_size_diff_percent=0):
+        self.plex = plex
+        self.media = media
+        self.part = part
+        self.opts = opts
+        self.downloaded_callback = downloaded_callback
+        self.max_allowed_size_diff_percent = max_allowed_size_diff_percent
+
+        self.filename = sanitize_filename(pretty_filename(media, part))
+        self.filename_tmp = self.filename + '.part'
+        self.savepath = os.path.join(opts.destination, sync_dirname(sync_title))
+        self.skipped = os.sep.join(os.path.join(self.savepath, self.filename).split(os.sep)[-2:]) in opts.skip
+
+        if media.TYPE == 'movie' and opts.subdir:
+            self.savepath = os.path.join(self.savepath, sanitize_filename(os.path.splitext(self.filename)[0]))
+
+        part_key = part.key
+        if part.decision == 'directplay':
+            part_key = '/' + '/'.join(part_key.split('/')[3:]) + '?download=1'
+        self.url = part._server.url(part_key)
+
+        self.path = os.path.join(self.savepath, self.filename)
+        self.path_tmp = os.path.join(self.savepath, self.filename_tmp)
+        self.path_segments = self.path_tmp + '.segments'
+
+        self.hasher = hashlib.new(opts.checksum) if opts.checksum else None
+        self.hashed = False
+        self.segmented = opts.download_segments > 1 and part.size >= opts.segmented_download_min_size
+        self.done = False
+
+        from .inventory import get_inventory
+        self.inventory = get_inventory(opts.destination)
+
+    @property
+    def token(self):
+        return self.plex.authenticationToken
+
+    def prepare(self):
+        log.debug('Checking media#%d %s', self.media.ratingKey, self.media.title)
+
+        if self.skipped:
+            log.info('Skipping file %s from %s due to cli arguments', self.filename, self.savepath)
+            self.done = True
+            return False
+
+        log.info('Downloading %s to %s, file size is %s', self.filename, self.savepath,
+                 format_size(self.part.size, binary=True))
+        inventory = self.inventory
+        inventory.makedirs(self.savepath)
+
+        path, path_tmp, path_segments = self.path, self.path_tmp, self.path_segments
+        size_tmp = inventory.get_size(path_tmp)
+
+        if size_tmp is None and inventory.get_size(path) == self.part.size:
+            # The file was downloaded, but wasn't recorded in the DB (e.g. the process was killed before the
+            # transaction commit)
+            log.info('File %s is already downloaded', path)
+            checksum = None
+            if self.hasher is not None:
+                checksum = hash_file(path, self.hasher, self.opts.download_chunk_size).hexdigest()
+            self.downloaded_callback(self.media, self.part, self.filename, checksum)
+            self.done = True
+            return False
+
+        has_segments = inventory.get_size(path_segments) is not None
+        if has_segments and not self.segmented:
+            # The file was preallocated by a segmented download, so it can't be resumed in a single stream
+            self.remove_partial()
+            size_tmp, has_segments = None, False
+
+        if not self.opts.resume_downloads and not self.segmented and size_tmp is not None \
+                and size_tmp != self.part.size:
+            inventory.unlink(path_tmp)
+            size_tmp = None
+
+        if size_tmp is not None and size_tmp > self.part.size:
+            log.error('File "%s" has an unexpected size (actual: %d, expected: %d), removing it', path_tmp,
+                      size_tmp, self.part.size)
+            inventory.unlink(path_tmp)
+            size_tmp = None
+
+        return size_tmp != self.part.size or has_segments
+
+    def remove_partial(self):
+        for p in (self.path_tmp, self.path_segments):
+            self.inventory.unlink(p)
+
+    def range_not_supported(self):
+        log.warning('Server does not support ranged requests, downloading %s in a single stream', self.filename)
+        self.segmented = False
+        self.remove_partial()
+
+    def transferred(self):
+        """ Records the files written by the transfer in the inventory, should be called even if it has failed. """
+        self.inventory.update(self.path_segments, self.path_tmp)
+
+    def transfer_failed(self):
+        self.transferred()
+        if not self.segmented and not self.opts.resume_downloads \
+                and self.inventory.get_size(self.path_tmp) not in (None, self.part.size):
+            self.inventory.unlink(self.path_tmp)
+
+    def transfer(self):
+        opts = self.opts
+        session = self.media._server._session
+
         try:
-            download(url, token=plex.authenticationToken, session=media._server._session, filename=filename_tmp,
-                     savepath=savepath, showstatus=True, rate_limit=opts.rate_limit)
+            if self.segmented:
+                try:
+                    download_segmented(self.url, token=self.token, session=session, filename=self.filename_tmp,
+                                       size=self.part.size, savepath=self.savepath, segments=opts.download_segments,
+                                       chunksize=opts.download_chunk_size, showstatus=True,
+                                       rate_limit=opts.rate_limit_per_download, buckets=rate_limit_buckets(opts),
+                                       prealloc=opts.preallocate)
+                except RangeNotSupported:
+                    self.range_not_supported()
+
+            if not self.segmented:
+                download(self.url, token=self.token, session=session, filename=self.filename_tmp,
+                         savepath=self.savepath, chunksize=opts.download_chunk_size, showstatus=True,
+                         rate_limit=opts.rate_limit_per_download, buckets=rate_limit_buckets(opts),
+                         prealloc=opts.preallocate, hasher=self.hasher)
+                self.hashed = True
         except BaseException:  # handle all exceptions, anyway we'll re-raise them
-            if os.path.isfile(path_tmp) and os.path.getsize(path_tmp) != part.size and not opts.resume_downloads:
-                os.unlink(path_tmp)
+            self.transfer_failed()
             raise
 
-    if not os.path.isfile(path_tmp) or abs(1 - os.path.getsize(path_tmp) / part.size) > max_allowed_size_diff_percent:
-        log.error('File "%s" has an unexpected size (actual: %d, expected: %d)', path_tmp,
-                  os.path.getsize(path_tmp), part.size)
-        raise ValueError('Downloaded file size is not the same as expected')
+        self.transferred()
+
+    def finish(self):
+        if self.done:
+            return
+
+        path_tmp, size = self.path_tmp, self.part.size
+        actual_size = self.inventory.get_size(path_tmp)
+        if actual_size is None or abs(1 - actual_size / size) > self.max_allowed_size_diff_percent:
+            log.error('File "%s" has an unexpected size (actual: %s, expected: %d)', path_tmp, actual_size, size)
+            raise ValueError('Downloaded file size is not the same as expected')
+
+        checksum = None
+        if self.hasher is not None:
+            if not self.hashed:
+                # Segments are written out of order, so segmented downloads (and files downloaded during previous
+                # runs) are hashed once they are complete
+                hash_file(path_tmp, self.hasher, self.opts.download_chunk_size)
+            checksum = self.hasher.hexdigest()
+            log.debug('%s checksum of %s is %s', self.opts.checksum, self.filename, checksum)
 
-    downloaded_callback(media, part, filename)
+        self.downloaded_callback(self.media, self.part, self.filename, checksum)
 
-    os.rename(path_tmp, path)
+        self.inventory.rename(path_tmp, self.path)
+        self.done = True
+
+
+def download_media(plex, sync_title, media, part, opts, downloaded_callback, max_allowed_size_diff_percent=0):
+    task = MediaDownload(plex, sync_title, media, part, opts, downloaded_callback, max_allowed_size_diff_percent)
+    if task.prepare():
+        task.transfer()
+    task.finish()
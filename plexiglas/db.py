@@ -1,21 +1,111 @@
+import json
 import sqlite3
+import threading
 from contextlib import contextmanager
 from uuid import uuid4
 from . import log, db_migrations
 
-CURRENT_VERSION = 3
+CURRENT_VERSION = 7
 _skip_migrations = False
 
+_conn = None
+_lock = threading.RLock()
+_transaction_depth = 0
+_trace_callback = None
 
-@contextmanager
-def _get_db():
-    conn = sqlite3.connect('.plexiglas.db', detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+
+def _connect():
+    conn = sqlite3.connect('.plexiglas.db', detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row
 
+    journal_mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+    log.debug('DB journal mode is %s', journal_mode)
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -8192')
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+    if _trace_callback is not None and hasattr(conn, 'set_trace_callback'):
+        conn.set_trace_callback(_trace_callback)
+
     apply_migrations(conn)
-    yield conn
 
-    conn.close()
+    return conn
+
+
+@contextmanager
+def _get_db():
+    """ Yields the shared connection, holding the lock, so it could be used from different threads. """
+    global _conn
+
+    with _lock:
+        if _conn is None:
+            _conn = _connect()
+        yield _conn
+
+
+def _commit(conn):
+    if _transaction_depth == 0:
+        conn.commit()
+
+
+@contextmanager
+def transaction():
+    """
+    Groups all the DB modifications within the block into a single transaction, the blocks may be nested. The
+    transaction is committed when the outermost block exits, even if it exits with an exception: everything written
+    to the DB reflects the files which are already on the disk.
+    """
+    global _transaction_depth
+
+    with _lock:
+        _transaction_depth += 1
+
+    try:
+        yield
+    finally:
+        with _get_db() as conn:
+            _transaction_depth -= 1
+            _commit(conn)
+
+
+@contextmanager
+def durable():
+    """
+    Commits the modifications within the block right when it exits, even within `transaction()` (committing the
+    modifications made by the transaction so far as well), for the records, which must not be lost if the process
+    dies. Other threads can't access the DB until the block exits, so the block is committed as a whole.
+    """
+    global _transaction_depth
+
+    with _get_db() as conn:
+        _transaction_depth += 1
+        try:
+            yield
+        finally:
+            _transaction_depth -= 1
+            conn.commit()
+
+
+def set_trace_callback(callback):
+    """ Sets the callback to be called for every SQL statement executed, None disables it. Not available on Python 2.
+    """
+    global _trace_callback
+
+    with _lock:
+        _trace_callback = callback
+        if _conn is not None and hasattr(_conn, 'set_trace_callback'):
+            _conn.set_trace_callback(callback)
+
+
+def close():
+    """ Closes the shared connection, the next DB call would open a new one. """
+    global _conn
+
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
 
 
 def apply_migrations(conn):
@@ -56,7 +146,7 @@ def set_param(name, value):
     with _get_db() as conn:
         conn.execute('INSERT OR IGNORE INTO settings (name, value) VALUES (?, "")', (name, ))
         conn.execute('UPDATE settings SET value = ? WHERE name = ?', (str(value), name))
-        conn.commit()
+        _commit(conn)
 
 
 def get_client_uuid():
@@ -69,7 +159,8 @@ def get_client_uuid():
     return uuid
 
 
-def mark_downloaded(machine_id, sync_type, sync_id, sync_title, media, filesize, filename, sync_version=1):
+def mark_downloaded(machine_id, sync_type, sync_id, sync_title, media, filesize, filename, sync_version=1,
+                    checksum=None):
     with _get_db() as conn:
         log.debug('Marking as downloaded item#%s, media#%d', sync_id, media.ratingKey)
         cur = conn.cursor()
@@ -86,15 +177,11 @@ def mark_downloaded(machine_id, sync_type, sync_id, sync_title, media, filesize,
         cur.execute('INSERT OR IGNORE INTO items (sync_id, media_id, title, filename, media_type) VALUES '
                     '(?, ?, "", "", "")',
                     (sync_id, media.ratingKey))
-        cur.execute('SELECT id FROM items WHERE sync_id = ? and media_id = ?', (sync_id, media.ratingKey))
-        item_id = cur.fetchone()[0]
-        log.debug('Media id in internal db %d', sync_id)
+        cur.execute('UPDATE items SET downloaded = 1, title = ?, filename = ?, filesize = ?, media_type = ?, '
+                    'checksum = ? WHERE sync_id = ? AND media_id = ?',
+                    (media.title, filename, filesize, media.TYPE, checksum, sync_id, media.ratingKey))
 
-        cur.execute('UPDATE items SET downloaded = 1, title = ?, filename = ?, filesize = ?, media_type = ? '
-                    'WHERE id = ?',
-                    (media.title, filename, filesize, media.TYPE, item_id))
-
-        conn.commit()
+        _commit(conn)
 
 
 def remove_downloaded(machine_id, sync_type, sync_id, media_id):
@@ -102,17 +189,32 @@ def remove_downloaded(machine_id, sync_type, sync_id, media_id):
         conn.execute('DELETE FROM items WHERE media_id = ? AND '
                      'sync_id = (SELECT id FROM syncs WHERE machine_id = ? AND sync_type = ? AND sync_id = ?)',
                      (media_id, machine_id, sync_type, sync_id))
-        conn.commit()
+        _commit(conn)
 
 
-def get_all_downloaded(sync_type):
+def remove_downloaded_items(item_ids):
+    """ Removes items by their ids in the internal DB. """
+    with _get_db() as conn:
+        for i in range(0, len(item_ids), 500):
+            chunk = item_ids[i:i + 500]
+            conn.execute('DELETE FROM items WHERE id IN (%s)' % (','.join('?' * len(chunk)), ), chunk)
+        _commit(conn)
+
+
+def get_all_downloaded(sync_type=None):
+    """ Returns all the downloaded items of the sync type, or of all the types if it's None. """
+    query = 'SELECT i.id, s.machine_id, s.sync_type, s.sync_id, i.media_id, s.title as sync_title, ' \
+            'i.media_type, i.filename as media_filename, i.filesize ' \
+            'FROM syncs s ' \
+            'JOIN items i ON i.sync_id = s.id ' \
+            'WHERE i.downloaded = 1'
+
     with _get_db() as conn:
         cur = conn.cursor()
-        cur.execute('SELECT i.id, s.machine_id, s.sync_type, s.sync_id, i.media_id, s.title as sync_title, '
-                    'i.media_type, i.filename as media_filename '
-                    'FROM syncs s '
-                    'JOIN items i ON i.sync_id = s.id '
-                    'WHERE i.downloaded = 1 AND s.sync_type = ?', (sync_type, ))
+        if sync_type is None:
+            cur.execute(query)
+        else:
+            cur.execute(query + ' AND s.sync_type = ?', (sync_type, ))
         return cur.fetchall()
 
 
@@ -147,3 +249,114 @@ def get_downloaded_size(media_type=None):
         else:
             cur.execute('SELECT SUM(filesize) FROM items i WHERE i.downloaded = 1')
         return cur.fetchone()[0] or 0
+
+
+def get_sync_state(machine_id, sync_type, sync_id):
+    """ Returns (watermark, required media ids, timestamp of the last full scan) or None. """
+    with _get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT watermark, required_media, full_scan_at FROM sync_states '
+                    'WHERE machine_id = ? AND sync_type = ? AND sync_id = ?', (machine_id, sync_type, sync_id))
+        ret = cur.fetchone()
+        if ret:
+            return ret['watermark'], json.loads(ret['required_media']), ret['full_scan_at']
+
+
+def set_sync_state(machine_id, sync_type, sync_id, watermark, required_media, full_scan_at):
+    with _get_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO sync_states (machine_id, sync_type, sync_id, watermark, required_media, '
+                     'full_scan_at) VALUES (?, ?, ?, ?, ?, ?)',
+                     (machine_id, sync_type, sync_id, watermark, json.dumps(required_media), int(full_scan_at)))
+        _commit(conn)
+
+
+def get_inventory():
+    """ Returns all the rows of the local files inventory: (directories, files). """
+    with _get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT path, mtime, scanned_at FROM inventory_dirs')
+        dirs = cur.fetchall()
+        cur.execute('SELECT dir, name, size, mtime, inode FROM inventory_files')
+        return dirs, cur.fetchall()
+
+
+def save_inventory_dir(path, mtime, scanned_at, files):
+    """ Replaces the inventory of the directory, `files` is a list of (name, size, mtime, inode). """
+    with _get_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO inventory_dirs (path, mtime, scanned_at) VALUES (?, ?, ?)',
+                     (path, mtime, scanned_at))
+        conn.execute('DELETE FROM inventory_files WHERE dir = ?', (path, ))
+        conn.executemany('INSERT INTO inventory_files (dir, name, size, mtime, inode) VALUES (?, ?, ?, ?, ?)',
+                         [(path, ) + tuple(f) for f in files])
+        _commit(conn)
+
+
+def remove_inventory_dirs(paths):
+    with _get_db() as conn:
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            conn.execute('DELETE FROM inventory_dirs WHERE path IN (%s)' % (placeholders, ), chunk)
+            conn.execute('DELETE FROM inventory_files WHERE dir IN (%s)' % (placeholders, ), chunk)
+        _commit(conn)
+
+
+def save_inventory_file(path, name, size, mtime, inode):
+    with _get_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO inventory_files (dir, name, size, mtime, inode) VALUES (?, ?, ?, ?, ?)',
+                     (path, name, size, mtime, inode))
+        _commit(conn)
+
+
+def remove_inventory_file(path, name):
+    with _get_db() as conn:
+        conn.execute('DELETE FROM inventory_files WHERE dir = ? AND name = ?', (path, name))
+        _commit(conn)
+
+
+def add_pending_ack(machine_id, client_id, media_id):
+    with _get_db() as conn:
+        conn.execute('INSERT OR IGNORE INTO pending_acks (machine_id, client_id, media_id) VALUES (?, ?, ?)',
+                     (machine_id, client_id, media_id))
+        _commit(conn)
+
+
+def get_pending_acks(now, limit):
+    """ Returns up to `limit` acknowledgements, which are due at `now`, ordered by the server. """
+    with _get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT id, machine_id, client_id, media_id, attempts FROM pending_acks '
+                    'WHERE next_attempt_at <= ? ORDER BY machine_id, id LIMIT ?', (now, limit))
+        return cur.fetchall()
+
+
+def get_pending_ack_media():
+    """ Returns the set of (machine id, media id) of all the pending acknowledgements. """
+    with _get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT machine_id, media_id FROM pending_acks')
+        return set((row['machine_id'], int(row['media_id'])) for row in cur.fetchall())
+
+
+def get_pending_acks_stats():
+    """ Returns (count of the pending acknowledgements, time of the nearest attempt or None). """
+    with _get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*), MIN(next_attempt_at) FROM pending_acks')
+        return tuple(cur.fetchone())
+
+
+def remove_pending_acks(ack_ids):
+    with _get_db() as conn:
+        for i in range(0, len(ack_ids), 500):
+            chunk = ack_ids[i:i + 500]
+            conn.execute('DELETE FROM pending_acks WHERE id IN (%s)' % (','.join('?' * len(chunk)), ), chunk)
+        _commit(conn)
+
+
+def postpone_pending_acks(postponed):
+    """ Records a failed attempt, `postponed` is a list of (ack id, time of the next attempt). """
+    with _get_db() as conn:
+        conn.executemany('UPDATE pending_acks SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?',
+                         [(next_attempt_at, ack_id) for ack_id, next_attempt_at in postponed])
+        _commit(conn)
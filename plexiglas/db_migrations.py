@@ -68,3 +68,56 @@ def apply_migration_2(conn):
         CREATE UNIQUE INDEX uidx_syncs_machine_id_sync_type_sync_id ON syncs(machine_id, sync_type, sync_id);
         DROP TABLE tmp_syncs;
     """ % (MobileSync.name, ))
+
+
+def apply_migration_3(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS sync_states (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            machine_id varchar(255) not null,
+            sync_type VARCHAR(50) NOT NULL,
+            sync_id VARCHAR(255) NOT NULL,
+            watermark varchar(255) not null,
+            required_media text not null,
+            full_scan_at integer not null default 0
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS uidx_sync_states_machine_id_sync_type_sync_id
+            ON sync_states(machine_id, sync_type, sync_id);
+    """)
+
+
+def apply_migration_4(conn):
+    conn.execute('ALTER TABLE items ADD COLUMN checksum varchar(255)')
+
+
+def apply_migration_5(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS inventory_dirs (
+            path text PRIMARY KEY,
+            mtime real,
+            scanned_at real not null default 0
+        );
+        CREATE TABLE IF NOT EXISTS inventory_files (
+            dir text not null,
+            name text not null,
+            size integer not null,
+            mtime real not null,
+            inode integer not null,
+            PRIMARY KEY (dir, name)
+        );
+    """)
+
+
+def apply_migration_6(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS pending_acks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            machine_id varchar(255) not null,
+            client_id varchar(255) not null,
+            media_id integer not null,
+            attempts integer not null default 0,
+            next_attempt_at real not null default 0
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS uidx_pending_acks_machine_id_client_id_media_id
+            ON pending_acks(machine_id, client_id, media_id);
+    """)
@@ -0,0 +1,311 @@
+"""
+Event-driven mode, enabled by `--watch-events`: instead of sleeping `--delay` seconds between the iterations, the next
+iteration starts as soon as something relevant has changed, and only the affected syncs are processed.
+
+The changes are detected by listening to the notifications websocket of every Plex server used during the previous
+iteration (library scans, processed items, finished activities), and by polling the sync list on plex.tv, which
+doesn't provide any push notifications. The sync items being transcoded are polled meanwhile as well (see
+`transcodes`). A full iteration is still performed every `--full-sync-interval` seconds.
+"""
+
+import json
+import re
+import threading
+from time import sleep, time
+
+from plexapi.alert import AlertListener
+
+from . import log
+from .transcodes import get_tracker
+
+# Timeline states of the items, see AlertListener's docstring: the item processed and the item deleted
+_TIMELINE_STATES = (5, 9)
+
+_SECTION_KEY_RE = re.compile(r'^/library/sections/(\d+)(?:[/?]|$)')
+
+
+def get_section_id(key):
+    """ Returns the library section id of the key like `/library/sections/1/all`, or None. """
+    match = _SECTION_KEY_RE.match(key)
+    return match.group(1) if match else None
+
+
+class SyncTrigger(object):
+    """
+    Describes what has changed since the previous iteration: whole servers, library sections and sync items.
+    A `full` trigger affects everything.
+    """
+
+    def __init__(self, full=False):
+        self.full = full
+        self.servers = set()
+        self.sections = set()
+        self.sync_items = set()
+
+    def __bool__(self):
+        return self.full or bool(self.servers or self.sections or self.sync_items)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        if self.full:
+            return '<SyncTrigger full>'
+
+        return '<SyncTrigger servers=%s sections=%s sync_items=%s>' % (
+            sorted(self.servers), sorted(self.sections), sorted(self.sync_items))
+
+    def update(self, other):
+        self.full = self.full or other.full
+        self.servers.update(other.servers)
+        self.sections.update(other.sections)
+        self.sync_items.update(other.sync_items)
+
+    def affects_section(self, machine_id, section_id=None):
+        """ Checks whether the section was changed; with `section_id=None` any change on the server counts. """
+        if self.full or machine_id in self.servers:
+            return True
+
+        if section_id is None:
+            return any(m == machine_id for m, _ in self.sections)
+
+        return (machine_id, str(section_id)) in self.sections
+
+    def affects_sync_item(self, machine_id, sync_id):
+        return self.affects_section(machine_id) or int(sync_id) in self.sync_items
+
+
+def parse_notification(machine_id, data):
+    """ Converts a message from the notifications websocket to SyncTrigger, or returns None if it's irrelevant. """
+    trigger = SyncTrigger()
+    kind = data.get('type')
+
+    if kind == 'timeline':
+        for entry in data.get('TimelineEntry', []):
+            if entry.get('identifier') != 'com.plexapp.plugins.library' \
+                    or int(entry.get('state', -1)) not in _TIMELINE_STATES:
+                continue
+
+            section_id = int(entry.get('sectionID', -1))
+            if section_id > 0:
+                trigger.sections.add((machine_id, str(section_id)))
+            else:
+                trigger.servers.add(machine_id)
+    elif kind == 'activity':
+        for entry in data.get('ActivityNotification', []):
+            activity = entry.get('Activity', {})
+            activity_type = activity.get('type', '')
+            if entry.get('event') != 'ended':
+                continue
+
+            section_id = activity.get('Context', {}).get('librarySectionID')
+            if activity_type.startswith('library.') and section_id:
+                trigger.sections.add((machine_id, str(section_id)))
+            elif activity_type.startswith('library.') or 'sync' in activity_type:
+                trigger.servers.add(machine_id)
+    elif kind == 'playing':
+        # Something was watched, so the lists of unwatched items may have changed
+        for entry in data.get('PlaySessionStateNotification', []):
+            if entry.get('state') == 'stopped':
+                trigger.servers.add(machine_id)
+
+    return trigger if trigger else None
+
+
+class ServerListener(AlertListener):
+    """ AlertListener, which reconnects when the connection is lost and survives unexpected messages. """
+
+    def __init__(self, server, callback, max_reconnect_delay=300):
+        super(ServerListener, self).__init__(server, callback)
+        self.name = 'plexiglas-events-%s' % server.machineIdentifier
+        self._max_reconnect_delay = max_reconnect_delay
+        self._stopped = threading.Event()
+        self._connected_once = False
+
+    def run(self):
+        import websocket
+
+        delay = 1
+        while not self._stopped.is_set():
+            url = self._server.url(self.key, includeToken=True).replace('http', 'ws', 1)
+            self._ws = websocket.WebSocketApp(url, on_open=self._onOpen, on_message=self._onMessage,
+                                              on_error=self._onError)
+            connected_at = time()
+            self._ws.run_forever()
+
+            if self._stopped.is_set():
+                break
+
+            if time() - connected_at > 60:
+                delay = 1
+
+            log.debug('Notifications connection to %s is lost, reconnecting in %d seconds',
+                      self._server.friendlyName, delay)
+            self._stopped.wait(delay)
+            delay = min(delay * 2, self._max_reconnect_delay)
+
+    def stop(self):
+        self._stopped.set()
+        if self._ws is not None:
+            self._ws.close()
+
+    def _onOpen(self, ws):
+        log.debug('Listening to notifications of %s', self._server.friendlyName)
+        if self._connected_once:
+            # Some notifications may have been missed while disconnected
+            trigger = SyncTrigger()
+            trigger.servers.add(self._server.machineIdentifier)
+            self._callback(trigger)
+        self._connected_once = True
+
+    def _onMessage(self, ws, message):
+        try:
+            data = json.loads(message)['NotificationContainer']
+            trigger = parse_notification(self._server.machineIdentifier, data)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            log.debug('Unexpected notification from %s: %s', self._server.friendlyName, message, exc_info=True)
+            return
+
+        if trigger is not None:
+            self._callback(trigger)
+
+    def _onError(self, ws, err):
+        log.debug('Notifications connection error from %s: %s', self._server.friendlyName, err)
+
+
+def sync_list_snapshot(plex):
+    """ Returns dict sync item id -> (machine id, version, count of items ready for download). """
+    return dict((item.id, (item.machineIdentifier, item.version, item.status.itemsReadyCount))
+                for item in plex.syncItems().items)
+
+
+def compare_sync_lists(old, new):
+    """ Returns SyncTrigger for the sync items, which were added, removed, updated or got new items ready. """
+    trigger = SyncTrigger()
+    for sync_id in set(old) | set(new):
+        if sync_id not in old or sync_id not in new:
+            trigger.sync_items.add(sync_id)
+            continue
+
+        old_machine_id, old_version, old_ready = old[sync_id]
+        machine_id, version, ready = new[sync_id]
+        if (old_machine_id, old_version) != (machine_id, version) or ready > old_ready:
+            trigger.sync_items.add(sync_id)
+
+    return trigger
+
+
+class EventWatcher(object):
+    """ Collects the triggers from all the sources and waits for them between the iterations. """
+
+    def __init__(self, opts):
+        self.opts = opts
+        self._listeners = {}
+        self._pending = SyncTrigger()
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._sync_list = None
+        self._sync_list_polled_at = 0
+        self._full_sync_at = time()
+
+    def notify(self, trigger):
+        with self._lock:
+            self._pending.update(trigger)
+        log.debug('Got %r', trigger)
+        self._event.set()
+
+    def request_full(self, delay=0):
+        """ Schedules the full iteration in `delay` seconds, e.g. to retry after an error. """
+        with self._lock:
+            self._pending.full = True
+            self._full_sync_at = min(self._full_sync_at, time() + delay - self.opts.full_sync_interval)
+
+    def subscribe(self, servers):
+        """ Starts listening to the notifications of the servers, which aren't listened yet. """
+        for server in servers:
+            machine_id = server.machineIdentifier
+            listener = self._listeners.get(machine_id)
+            if listener is not None and listener.is_alive():
+                continue
+
+            listener = ServerListener(server, self.notify)
+            listener.start()
+            self._listeners[machine_id] = listener
+
+    def stop(self):
+        for listener in self._listeners.values():
+            listener.stop()
+        self._listeners.clear()
+
+    def poll_sync_list(self, plex):
+        from requests import exceptions
+
+        self._sync_list_polled_at = time()
+        try:
+            snapshot = sync_list_snapshot(plex)
+        except exceptions.RequestException:
+            log.debug('Unable to fetch the sync list', exc_info=True)
+            return
+
+        if self._sync_list is not None:
+            trigger = compare_sync_lists(self._sync_list, snapshot)
+            if trigger:
+                self.notify(trigger)
+
+        self._sync_list = snapshot
+
+    def poll_transcodes(self, tracker):
+        trigger = SyncTrigger()
+        for _, sync_id in tracker.poll():
+            trigger.sync_items.add(int(sync_id))
+
+        if trigger:
+            self.notify(trigger)
+
+    def wait(self, plex):
+        """
+        Blocks until something has changed or until it's time for the full iteration, and returns SyncTrigger
+        describing the changes. The sync list is polled meanwhile, once in `--sync-list-poll-interval` seconds, and so
+        are the sync items being transcoded.
+        """
+        tracker = get_tracker(self.opts)
+        if plex is not None and self._sync_list is None and self.opts.sync_list_poll_interval > 0:
+            self.poll_sync_list(plex)
+
+        while True:
+            now = time()
+            deadline = self._full_sync_at + self.opts.full_sync_interval
+            if now >= deadline:
+                break
+
+            timeout = deadline - now
+            if plex is not None and self.opts.sync_list_poll_interval > 0:
+                timeout = min(timeout, max(0, self._sync_list_polled_at + self.opts.sync_list_poll_interval - now))
+
+            transcode_poll_at = tracker.next_poll_at() if tracker is not None else None
+            if transcode_poll_at is not None:
+                timeout = min(timeout, max(0, transcode_poll_at - now))
+
+            if self._event.wait(timeout):
+                # Let a library scan or a bunch of transcodes to finish, to handle all of them at once
+                sleep(self.opts.events_debounce)
+                break
+
+            if plex is not None and self.opts.sync_list_poll_interval > 0 \
+                    and time() >= self._sync_list_polled_at + self.opts.sync_list_poll_interval:
+                self.poll_sync_list(plex)
+
+            if transcode_poll_at is not None and time() >= transcode_poll_at:
+                self.poll_transcodes(tracker)
+
+        with self._lock:
+            trigger = self._pending
+            self._pending = SyncTrigger()
+            self._event.clear()
+
+        if time() >= self._full_sync_at + self.opts.full_sync_interval:
+            trigger.full = True
+
+        if trigger.full:
+            self._full_sync_at = time()
+
+        return trigger
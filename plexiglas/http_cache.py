@@ -0,0 +1,181 @@
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from time import time
+
+from requests.adapters import HTTPAdapter
+
+from . import log
+
+
+_SKIPPED_HEADERS = ('if-none-match', 'if-modified-since', 'cache-control')
+
+# The sync lists (`/devices/<client id>/sync_items` on plex.tv) and the sync items' media (`/sync/items/<id>`) change
+# on their own while the server transcodes, so they are never cached
+_UNCACHED_PATHS = ('/sync/', '/sync_items')
+
+
+class CacheEntry(object):
+    __slots__ = ['status_code', 'reason', 'headers', 'content', 'encoding', 'url', 'stored_at']
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = dict(response.headers)
+        self.content = response.content
+        self.encoding = response.encoding
+        self.url = response.url
+        self.stored_at = time()
+
+    @property
+    def size(self):
+        return len(self.content)
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag') or self.headers.get('etag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified') or self.headers.get('last-modified')
+
+    def build_response(self, request, adapter):
+        from requests.models import Response
+        from requests.structures import CaseInsensitiveDict
+
+        response = Response()
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.content
+        response._content_consumed = True
+        response.encoding = self.encoding
+        response.url = self.url
+        response.request = request
+        response.connection = adapter
+        response.elapsed = timedelta(0)
+        response.from_cache = True
+
+        return response
+
+
+class MetadataCache(object):
+    """
+    In-memory LRU cache for the metadata responses, limited by the total size of the cached bodies.
+
+    The responses are served from the cache without any request for `ttl` seconds. Afterwards (or when the request has
+    `Cache-Control: no-cache` header) the responses with `ETag` or `Last-Modified` are revalidated with a conditional
+    request, and the rest are requested again.
+    """
+
+    def __init__(self, ttl=0, max_size=16 * 1024 ** 2):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(request):
+        headers = tuple(sorted((k.lower(), v) for k, v in request.headers.items() if k.lower() not in _SKIPPED_HEADERS))
+        return request.url, headers
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        if entry.size > self.max_size:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+
+            self._entries[key] = entry
+            self.size += entry.size
+
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'revalidations': self.revalidations, 'misses': self.misses,
+                    'entries': len(self._entries), 'size': self.size}
+
+
+class CachingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter serving plain GET requests from MetadataCache. Streaming and ranged requests (i.e. the downloads), and
+    the mobile sync state (see `_UNCACHED_PATHS`) are never cached; any other request, as well as a call of a Plex
+    action (`/:/scrobble` etc), drops the whole cache, because it may change the server's state.
+    """
+
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super(CachingHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != 'GET' or '/:/' in request.path_url:
+            if request.method not in ('HEAD', 'OPTIONS'):
+                self.cache.clear()
+            return super(CachingHTTPAdapter, self).send(request, stream=stream, **kwargs)
+
+        if stream or 'Range' in request.headers or any(p in request.path_url for p in _UNCACHED_PATHS):
+            return super(CachingHTTPAdapter, self).send(request, stream=stream, **kwargs)
+
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+
+        if entry is not None and 'no-cache' not in request.headers.get('Cache-Control', '') \
+                and time() - entry.stored_at < self.cache.ttl:
+            self.cache.count('hits')
+            return entry.build_response(request, self)
+
+        if entry is not None:
+            if entry.etag:
+                request.headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request.headers['If-Modified-Since'] = entry.last_modified
+
+        response = super(CachingHTTPAdapter, self).send(request, stream=stream, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.count('revalidations')
+            response.close()
+            entry.stored_at = time()
+            response = entry.build_response(request, self)
+            response.from_cache = False
+            return response
+
+        self.cache.count('misses')
+
+        if response.status_code == 200 and 'no-store' not in response.headers.get('Cache-Control', ''):
+            new_entry = CacheEntry(response)
+            if self.cache.ttl > 0 or new_entry.etag or new_entry.last_modified:
+                self.cache.put(key, new_entry)
+
+        return response
+
+
+def log_stats(cache):
+    stats = cache.stats()
+    log.debug('Metadata cache: %(hits)d hits, %(revalidations)d revalidations, %(misses)d misses, %(entries)d '
+              'entries, %(size)d bytes', stats)
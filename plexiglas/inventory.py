@@ -0,0 +1,334 @@
+"""
+Index of the files within the destination directory (name, size, mtime and inode of every file), stored in the DB.
+
+The index is refreshed once in an iteration: every known directory is stat'ed, and only the directories with a changed
+mtime are listed again, so an idle iteration costs a stat per directory instead of a stat per file, which matters on
+an external HDD, where every access may spin the disk up. The changes made by plexiglas itself (downloads, renames,
+removals) are recorded in the index right away.
+
+The index is trusted only to tell that a file is missing: a size of an existing file is always read from the disk, so
+a stale entry (e.g. of a `.part` file, which was being written when the process was killed) is never used.
+"""
+
+import errno
+import os
+import stat
+import threading
+from time import time
+
+from . import db, log
+
+# Directories modified within this amount of seconds before their scan are listed again during the next refresh, as
+# mtime granularity of some filesystems (e.g. FAT) is 2 seconds
+RACY_WINDOW = 2
+
+_inventory = None
+_lock = threading.Lock()
+
+
+class _Dir(object):
+    __slots__ = ['mtime', 'scanned_at', 'subdirs', 'files']
+
+    def __init__(self, mtime=None, scanned_at=0):
+        self.mtime = mtime
+        self.scanned_at = scanned_at
+        self.subdirs = set()
+        self.files = {}
+
+
+def _iter_entries(path):
+    """ Yields (name, is_dir, inode, stat function) for every directory and regular file within the directory. """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.name, True, None, None
+            elif entry.is_file():
+                yield entry.name, False, entry.inode(), entry.stat
+    else:
+        for name in os.listdir(path):
+            st = os.lstat(os.path.join(path, name))
+            if stat.S_ISDIR(st.st_mode):
+                yield name, True, None, None
+            elif stat.S_ISREG(st.st_mode):
+                yield name, False, st.st_ino, lambda st=st: st
+
+
+class Inventory(object):
+    """ Index of the files within `root`, see the module docstring. All the paths are absolute. """
+
+    def __init__(self, root):
+        self.root = root
+        self.refreshed_at = None
+        self._dirs = {}
+        self._lock = threading.RLock()
+
+    def load(self):
+        dirs, files = db.get_inventory()
+
+        with self._lock:
+            self._dirs = dict((row['path'], _Dir(row['mtime'], row['scanned_at'])) for row in dirs)
+            for path in self._dirs:
+                parent = self._dirs.get(os.path.dirname(path)) if path else None
+                if parent is not None:
+                    parent.subdirs.add(os.path.basename(path))
+
+            for row in files:
+                d = self._dirs.get(row['dir'])
+                if d is not None:
+                    d.files[row['name']] = (row['size'], row['mtime'], row['inode'])
+
+    def _relpath(self, path):
+        """ Returns the path relative to the root, '' for the root itself, or None if it's outside of the root. """
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if rel == os.curdir:
+            return ''
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            return None
+        return rel
+
+    def refresh(self, workers=1):
+        """
+        Brings the index up to date with the disk. The tree is walked level by level, the directories of the same level
+        are checked in up to `workers` threads.
+        """
+        from .scheduler import parallel_map
+
+        begin = time()
+        counters = {'dirs': 0, 'scanned': 0}
+
+        with self._lock:
+            level = ['']
+            while level:
+                next_level = []
+                for rel, probe in zip(level, parallel_map(self._probe, level, workers)):
+                    d = self._apply(rel, probe, counters)
+                    if d is not None:
+                        next_level.extend(os.path.join(rel, name) for name in d.subdirs)
+                level = next_level
+
+            self.refreshed_at = time()
+
+        log.debug('Inventory is refreshed in %.3f seconds: %d of %d directories are listed', time() - begin,
+                  counters['scanned'], counters['dirs'])
+
+    def _probe(self, rel):
+        """
+        Checks the directory without modifying the index, so it may be called from different threads. Returns None if
+        the directory is missing, (mtime, None, None) if it's unchanged, or (mtime, scan time, (subdirs, files)).
+        """
+        path = os.path.join(self.root, rel)
+        known = self._dirs.get(rel)
+
+        try:
+            mtime = os.stat(path).st_mtime
+            if known is not None and known.mtime == mtime and mtime < known.scanned_at - RACY_WINDOW:
+                return mtime, None, None
+
+            scanned_at = time()
+            entries = list(_iter_entries(path))
+        except OSError:
+            return None
+
+        subdirs = set()
+        files = {}
+        for name, is_dir, inode, get_stat in entries:
+            if is_dir:
+                subdirs.add(name)
+                continue
+
+            cached = known.files.get(name) if known is not None else None
+            if cached is not None and cached[2] == inode:
+                # Modifying a file doesn't change the directory's mtime, so the size is expected to be the same
+                files[name] = cached
+                continue
+
+            try:
+                st = get_stat()
+            except OSError:
+                continue
+            files[name] = (st.st_size, st.st_mtime, st.st_ino)
+
+        return mtime, scanned_at, (subdirs, files)
+
+    def _apply(self, rel, probe, counters):
+        if probe is None:
+            self._forget_dir(rel)
+            return None
+
+        counters['dirs'] += 1
+        mtime, scanned_at, listing = probe
+        if listing is None:
+            return self._dirs[rel]
+
+        counters['scanned'] += 1
+        known = self._dirs.get(rel)
+        d = _Dir(mtime, scanned_at)
+        d.subdirs, d.files = listing
+
+        if known is not None:
+            for name in known.subdirs - d.subdirs:
+                self._forget_dir(os.path.join(rel, name))
+
+        self._dirs[rel] = d
+        db.save_inventory_dir(rel, mtime, scanned_at, [(name, ) + f for name, f in d.files.items()])
+
+        return d
+
+    def _forget_dir(self, rel):
+        removed = [p for p in self._dirs if p == rel or p.startswith(rel + os.sep)] if rel else list(self._dirs)
+        for p in removed:
+            del self._dirs[p]
+
+        if rel:
+            parent = self._dirs.get(os.path.dirname(rel))
+            if parent is not None:
+                parent.subdirs.discard(os.path.basename(rel))
+
+        if removed:
+            db.remove_inventory_dirs(removed)
+
+    def _ensure_dir(self, rel):
+        d = self._dirs.get(rel)
+        if d is None:
+            d = self._dirs[rel] = _Dir()
+            db.save_inventory_dir(rel, None, 0, [])
+            if rel:
+                self._ensure_dir(os.path.dirname(rel)).subdirs.add(os.path.basename(rel))
+
+        return d
+
+    def makedirs(self, path):
+        """ Creates the directory, unless it's known to exist. """
+        rel = self._relpath(path)
+        with self._lock:
+            if rel is not None and rel in self._dirs:
+                return
+
+            from .content import makedirs
+            makedirs(path, exist_ok=True)
+
+            if rel is not None:
+                # mtime is unknown, so the directory will be listed during the next refresh
+                self._ensure_dir(rel)
+
+    def list_files(self, path):
+        """ Returns the set of the files names within the directory, or an empty set if the directory doesn't exist. """
+        rel = self._relpath(path)
+        if rel is None:
+            from .content import list_files
+            return list_files(path)
+
+        with self._lock:
+            d = self._dirs.get(rel)
+            return set(d.files) if d is not None else set()
+
+    def get_size(self, path):
+        """ Returns the size of the file, or None if it doesn't exist. The disk is accessed only for known files. """
+        rel = self._relpath(path)
+        if rel is not None:
+            with self._lock:
+                d = self._dirs.get(os.path.dirname(rel))
+                if d is None or os.path.basename(rel) not in d.files:
+                    return None
+
+        st = self.update(path)
+        return st.st_size if st is not None else None
+
+    def update(self, *paths):
+        """ Records the current state of the files in the index, returns stat of the last one or None if it's missing.
+        """
+        st = None
+        for path in paths:
+            try:
+                st = os.stat(path)
+                if not stat.S_ISREG(st.st_mode):
+                    st = None
+            except OSError:
+                st = None
+
+            rel = self._relpath(path)
+            if rel is None:
+                continue
+
+            dirname, name = os.path.dirname(rel), os.path.basename(rel)
+            with self._lock:
+                if st is not None:
+                    entry = (st.st_size, st.st_mtime, st.st_ino)
+                    d = self._ensure_dir(dirname)
+                    if d.files.get(name) != entry:
+                        d.files[name] = entry
+                        db.save_inventory_file(dirname, name, *entry)
+                else:
+                    d = self._dirs.get(dirname)
+                    if d is not None and d.files.pop(name, None) is not None:
+                        db.remove_inventory_file(dirname, name)
+
+        return st
+
+    def unlink(self, path):
+        """ Removes the file, if it exists. """
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.update(path)
+
+    def rename(self, src, dst):
+        os.rename(src, dst)
+        self.update(src, dst)
+
+    def get_files(self):
+        """ Returns the list of (path, size) of all the files within the root. """
+        with self._lock:
+            return [(os.path.join(self.root, rel, name), f[0]) for rel, d in self._dirs.items()
+                    for name, f in d.files.items()]
+
+    def get_total_size(self, exclude=()):
+        """ Returns the total size of all the files within the root, except the `exclude` paths. """
+        excluded = 0
+        with self._lock:
+            for path in exclude:
+                rel = self._relpath(path)
+                d = self._dirs.get(os.path.dirname(rel)) if rel is not None else None
+                if d is not None and os.path.basename(rel) in d.files:
+                    excluded += d.files[os.path.basename(rel)][0]
+
+            return sum(f[0] for d in self._dirs.values() for f in d.files.values()) - excluded
+
+
+def _get(destination):
+    global _inventory
+
+    root = os.path.abspath(destination)
+    with _lock:
+        if _inventory is None or _inventory.root != root:
+            _inventory = Inventory(root)
+            _inventory.load()
+
+        return _inventory
+
+
+def get_inventory(destination):
+    """ Returns the inventory of the destination directory, it's loaded and refreshed on the first call. """
+    inventory = _get(destination)
+    if inventory.refreshed_at is None:
+        inventory.refresh()
+
+    return inventory
+
+
+def refresh(destination, workers=1):
+    """ Refreshes the inventory of the destination directory, should be called once in an iteration. """
+    inventory = _get(destination)
+    inventory.refresh(workers)
+
+    return inventory
+
+
+def reset():
+    """ Forgets the loaded inventory, e.g. when the destination directory disappears. """
+    global _inventory
+
+    with _lock:
+        _inventory = None
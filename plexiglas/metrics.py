@@ -0,0 +1,212 @@
+"""
+Counters and gauges describing the state of the process, exposed in Prometheus text format either via HTTP
+(`--metrics-port`) or as a file for node_exporter's textfile collector (`--metrics-textfile`).
+"""
+
+import os
+import platform
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import time
+
+from . import log
+
+
+THROUGHPUT_WINDOW = 10
+
+_DEFINITIONS = {
+    'plexiglas_downloaded_bytes_total': ('counter', 'Bytes received from the servers'),
+    'plexiglas_downloaded_files_total': ('counter', 'Files downloaded completely'),
+    'plexiglas_download_failures_total': ('counter', 'Failed downloads'),
+    'plexiglas_download_throughput_bytes': ('gauge', 'Download speed over the last %d seconds, bytes per second'
+                                            % THROUGHPUT_WINDOW),
+    'plexiglas_download_queue_depth': ('gauge', 'Files waiting for download or being downloaded'),
+    'plexiglas_phase_duration_seconds': ('gauge', 'Duration of the phase during the last iteration'),
+    'plexiglas_phase_seconds_total': ('counter', 'Total time spent in the phase'),
+    'plexiglas_iterations_total': ('counter', 'Finished iterations'),
+    'plexiglas_iteration_errors_total': ('counter', 'Iterations finished with an error'),
+    'plexiglas_last_iteration_timestamp_seconds': ('gauge', 'Time of the last successful iteration'),
+    'plexiglas_disk_used_bytes': ('gauge', 'Size of the downloaded files according to the DB'),
+    'plexiglas_disk_limit_bytes': ('gauge', 'Disk usage limit, 0 if not limited'),
+    'plexiglas_destination_files_bytes': ('gauge', 'Size of all the files within the destination directory'),
+    'plexiglas_partial_bytes': ('gauge', 'Size of the partially downloaded files'),
+    'plexiglas_orphaned_bytes': ('gauge', 'Size of the files within the destination directory unknown to the DB'),
+    'plexiglas_orphaned_files': ('gauge', 'Count of the files within the destination directory unknown to the DB'),
+    'plexiglas_missing_files': ('gauge', 'Count of the downloaded files according to the DB missing on the disk'),
+    'plexiglas_size_mismatch_files': ('gauge', 'Count of the downloaded files with a size different from the DB'),
+    'plexiglas_pending_acks': ('gauge', 'Download acknowledgements waiting to be sent to the servers'),
+    'plexiglas_db_size_bytes': ('gauge', 'Size of the DB files'),
+    'plexiglas_http_requests_total': ('counter', 'HTTP requests sent to Plex servers and plex.tv'),
+    'plexiglas_metadata_bytes_total': ('counter', 'Bytes of XML and JSON responses received from Plex servers and '
+                                                  'plex.tv'),
+    'plexiglas_db_queries_total': ('counter', 'SQL statements executed, only counted with --profile on Python 3'),
+}
+
+_values = {}
+_throughput = deque()
+_iteration_phases = {}
+_lock = threading.Lock()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """ Increments a counter, or a gauge, by the value. """
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def get_value(name, **labels):
+    with _lock:
+        return _values.get(_key(name, labels), 0)
+
+
+def set_value(name, value, **labels):
+    with _lock:
+        _values[_key(name, labels)] = value
+
+
+def add_downloaded(size):
+    """ Accounts bytes received from the server. """
+    now = int(time())
+    with _lock:
+        key = _key('plexiglas_downloaded_bytes_total', {})
+        _values[key] = _values.get(key, 0) + size
+
+        if _throughput and _throughput[-1][0] == now:
+            _throughput[-1][1] += size
+        else:
+            _throughput.append([now, size])
+
+
+def _current_throughput():
+    threshold = int(time()) - THROUGHPUT_WINDOW
+    while _throughput and _throughput[0][0] <= threshold:
+        _throughput.popleft()
+
+    return float(sum(size for _, size in _throughput)) / THROUGHPUT_WINDOW
+
+
+def start_iteration():
+    """ Resets the durations of the phases accumulated during the previous iteration, see `phase()`. The phases, which
+        don't run during the iteration (e.g. `resources`), report 0.
+    """
+    with _lock:
+        _iteration_phases.clear()
+        for key in _values:
+            if key[0] == 'plexiglas_phase_duration_seconds':
+                _values[key] = 0
+
+
+@contextmanager
+def phase(name):
+    """ Measures the duration of the block as the phase of the iteration. The phase may consist of several blocks
+        (e.g. one per plugin), their durations are summed up till the next `start_iteration()`.
+    """
+    begin = time()
+    try:
+        yield
+    finally:
+        duration = time() - begin
+        with _lock:
+            _iteration_phases[name] = _iteration_phases.get(name, 0) + duration
+            _values[_key('plexiglas_phase_duration_seconds', {'phase': name})] = _iteration_phases[name]
+        inc('plexiglas_phase_seconds_total', duration, phase=name)
+
+
+def update_storage(opts):
+    """ Refreshes the gauges describing disk usage, should be called once in an iteration. """
+    from . import db
+    from .inventory import get_inventory
+
+    set_value('plexiglas_disk_used_bytes', db.get_downloaded_size())
+    set_value('plexiglas_disk_limit_bytes', opts.limit_disk_usage or 0)
+    set_value('plexiglas_destination_files_bytes', get_inventory(opts.destination).get_total_size())
+
+    db_size = 0
+    for suffix in ('', '-wal', '-shm'):
+        path = '.plexiglas.db' + suffix
+        if os.path.isfile(path):
+            db_size += os.path.getsize(path)
+    set_value('plexiglas_db_size_bytes', db_size)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def render():
+    """ Returns all the metrics in Prometheus text format. """
+    with _lock:
+        _values[_key('plexiglas_download_throughput_bytes', {})] = _current_throughput()
+        values = sorted(_values.items())
+
+    lines = []
+    last_name = None
+    for (name, labels), value in values:
+        if name != last_name:
+            metric_type, description = _DEFINITIONS.get(name, ('untyped', name))
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            last_name = name
+        lines.append('%s%s %s' % (name, _format_labels(labels), repr(float(value))))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    """ Writes the metrics to the file atomically, so the textfile collector never reads a partial file. """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as handle:
+        handle.write(render())
+    if platform.system() == 'Windows' and os.path.exists(path):
+        os.unlink(path)
+    os.rename(tmp_path, path)
+
+
+def start_http_server(port, address=''):
+    """ Serves the metrics on http://address:port/metrics in a background thread. """
+    from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug('Metrics request: ' + format, *args)
+
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='plexiglas-metrics')
+    thread.daemon = True
+    thread.start()
+    log.info('Serving metrics on %s:%d', address or '*', port)
+
+    return server
+
+
+def count_response(response, *args, **kwargs):
+    """ requests response hook, counting the requests and the size of metadata responses. """
+    if getattr(response, 'from_cache', False):
+        return
+
+    inc('plexiglas_http_requests_total')
+
+    content_type = response.headers.get('Content-Type', '')
+    if 'xml' in content_type or 'json' in content_type:
+        inc('plexiglas_metadata_bytes_total', int(response.headers.get('Content-Length') or 0))
@@ -1,11 +1,18 @@
 from collections import defaultdict
 from itertools import groupby
-from operator import itemgetter
 from keyring.util import properties
+from plexapi.exceptions import NotFound
 
-from . import log, db
-from .content import get_available_disk_space, download_media
+from . import acks, log, db
+from .plex import get_server
+from .planner import SyncPlan, execute_plans
+from .reconcile import get_disk_used
 from .plugin import PlexiglasPlugin
+from .scheduler import DownloadJob, parallel_map
+from .transcodes import get_tracker
+
+# syncState of the parts, which are transcoded already
+TRANSCODED_STATES = ('processed', 'downloaded')
 
 
 class MobileSync(PlexiglasPlugin):
@@ -15,58 +22,144 @@ class MobileSync(PlexiglasPlugin):
         return 100
 
     @classmethod
-    def get_download_part(cls, media, sync_item):
-        for part in media.iterParts():
-            if part.syncItemId == sync_item.id and part.syncState == 'processed':
-                return part
+    def get_download_parts(cls, media_list, sync_item):
+        """ Returns dict media.ratingKey -> part processed for the sync item, which is ready for download. """
+        parts = {}
+        for media in media_list:
+            for part in media.iterParts():
+                if part.syncItemId == sync_item.id and part.syncState == 'processed':
+                    parts[media.ratingKey] = part
+                    break
+
+        return parts
 
     @classmethod
-    def sync(cls, plex, opts):
+    def count_transcoding(cls, media_list, sync_item):
+        """
+        Returns the count of the media, which are still being transcoded for the sync item, i.e. neither processed nor
+        downloaded, the same as `itemsCount - itemsCompleteCount` of the item's status.
+        """
+        count = 0
+        for media in media_list:
+            for part in media.iterParts():
+                if part.syncItemId == sync_item.id:
+                    if part.syncState not in TRANSCODED_STATES:
+                        count += 1
+                    break
+
+        return count
+
+    @classmethod
+    def track_transcodes(cls, plex, opts, sync_item, pending):
+        """ Makes the tracker to poll the sync item while its media are being transcoded, see `transcodes`. """
+        tracker = get_tracker(opts)
+        if tracker is None:
+            return
+
+        def check():
+            return cls.count_transcoding(cls.get_media(plex, opts, sync_item, fresh=True), sync_item)
+
+        tracker.track((sync_item.machineIdentifier, sync_item.id), check, pending)
+
+    @classmethod
+    def get_media(cls, plex, opts, sync_item, fresh=False):
+        """ Same as `SyncItem.getMedia()`, but reuses the connection to the server instead of requesting the resources
+            and connecting to the server for every item. With `fresh` the metadata cache is bypassed, so the polls
+            of the transcoding progress see the actual states of the parts.
+        """
+        server = get_server(plex, sync_item.machineIdentifier, opts.resources_ttl)
+        if server is None:
+            raise NotFound('Unable to find server with uuid %s' % sync_item.machineIdentifier)
+
+        key = '/sync/items/%s' % sync_item.id
+        if not fresh:
+            return server.fetchItems(key)
+
+        return server.findItems(server.query(key, headers={'Cache-Control': 'no-cache'}), initpath=key)
+
+    @classmethod
+    def mark_downloaded_callback(cls, item):
+        def mark_downloaded(media, part, filename, checksum=None):
+            # The acknowledgement may be sent right away, so both records are committed at once: otherwise the server
+            # could consider the media downloaded, while the DB, rolled back after a crash, doesn't know about it
+            with db.durable():
+                db.mark_downloaded(item.machineIdentifier, cls.name, item.id, item.title, media, part.size, filename,
+                                   sync_version=item.version, checksum=checksum)
+                acks.enqueue(item.machineIdentifier, item.clientIdentifier, media.ratingKey)
+
+        return mark_downloaded
+
+    @classmethod
+    def plan(cls, plex, opts, trigger=None):
         sync_items = plex.syncItems().items
         required_media = []
-        disk_used = db.get_downloaded_size()
+        jobs = []
+        limit_exceeded = bool(opts.limit_disk_usage) and get_disk_used(opts) > opts.limit_disk_usage
 
-        all_downloaded_items = db.get_all_downloaded(cls.name)
-        downloaded_count = defaultdict(lambda: defaultdict(int))
+        downloaded_media = defaultdict(set)
+        for row in db.get_all_downloaded(cls.name):
+            downloaded_media[(str(row['machine_id']), str(row['sync_id']))].add(int(row['media_id']))
 
-        for (machine_id, sync_id), items in groupby(all_downloaded_items, key=itemgetter('machine_id', 'sync_id')):
-            downloaded_count[str(machine_id)][str(sync_id)] = len(list(items))
+        # The media downloaded, but not acknowledged yet, are still ready for download according to the server
+        pending_acks = db.get_pending_ack_media()
 
         skipped_syncs = []
+        changed_items = []
 
         for item in sync_items:
             log.debug('Checking sync item#%d %s', item.id, item.title)
+            transcoding = (item.status.itemsCount or 0) - (item.status.itemsCompleteCount or 0)
+            item_downloaded = downloaded_media[(str(item.machineIdentifier), str(item.id))]
+            unacknowledged = len([m for m in item_downloaded if (item.machineIdentifier, m) in pending_acks])
 
-            if item.status.itemsReadyCount == 0 \
-                    and item.status.itemsDownloadedCount == downloaded_count[str(item.machineIdentifier)][str(item.id)]:
+            if item.status.itemsReadyCount - unacknowledged <= 0 \
+                    and item.status.itemsDownloadedCount + unacknowledged == len(item_downloaded):
                 skipped_syncs.append((item.machineIdentifier, item.id))
                 log.debug('No changes for the item#%d %s', item.id, item.status)
+                if not limit_exceeded:
+                    cls.track_transcodes(plex, opts, item, transcoding)
                 continue
 
-            if opts.limit_disk_usage and disk_used > opts.limit_disk_usage:
+            if trigger is not None and not trigger.affects_sync_item(item.machineIdentifier, item.id):
                 skipped_syncs.append((item.machineIdentifier, item.id))
-                log.debug('Disk limit exceeded, skipping item#%d', item.id)
+                log.debug('Item#%d is not affected by the changes, skipping', item.id)
+                if not limit_exceeded:
+                    cls.track_transcodes(plex, opts, item, transcoding)
                 continue
 
-            for media in item.getMedia():
-                required_media.append((item.machineIdentifier, media.ratingKey))
-                part = cls.get_download_part(media, item)
-                if part:
-                    if opts.limit_disk_usage and disk_used + part.size > opts.limit_disk_usage:
-                        log.debug('Not downloading %s from %s, size limit would be exceeded', media.title,
-                                  item.title)
-                        continue
+            if limit_exceeded:
+                skipped_syncs.append((item.machineIdentifier, item.id))
+                log.debug('Disk limit exceeded, skipping item#%d', item.id)
+                continue
 
-                    if get_available_disk_space(opts.destination) < part.size:
-                        log.debug('Not downloading %s from %s, due to low available space', media.title, item.title)
-                        continue
+            changed_items.append(item)
 
-                    def mark_downloaded(media, part, filename):
-                        db.mark_downloaded(item.machineIdentifier, cls.name, item.id, item.title, media, part.size,
-                                           filename, sync_version=item.version)
-                        item.markDownloaded(media)
+        items_media = parallel_map(lambda i: cls.get_media(plex, opts, i), changed_items, opts.mobile_sync_concurrency)
 
-                    download_media(plex, item.title, media, part, opts, mark_downloaded)
+        for item, media_list in zip(changed_items, items_media):
+            mark_downloaded = cls.mark_downloaded_callback(item)
+            parts = cls.get_download_parts(media_list, item)
+            for media in media_list:
+                required_media.append((item.machineIdentifier, media.ratingKey))
+                part = parts.get(media.ratingKey)
+                if not part:
+                    continue
+
+                key = (item.machineIdentifier, int(media.ratingKey))
+                if key[1] in downloaded_media[(str(item.machineIdentifier), str(item.id))]:
+                    if key not in pending_acks:
+                        # Downloaded, but the acknowledgement is lost, e.g. it was recorded before the queue existed
+                        with db.durable():
+                            acks.enqueue(item.machineIdentifier, item.clientIdentifier, media.ratingKey)
+                        pending_acks.add(key)
+                    continue
+
+                jobs.append(DownloadJob(item.title, media, part, mark_downloaded))
+            cls.track_transcodes(plex, opts, item, cls.count_transcoding(media_list, item))
+
+        tracker = get_tracker(opts)
+        if tracker is not None:
+            tracker.retain([] if limit_exceeded else [(item.machineIdentifier, item.id) for item in sync_items])
 
         if len(skipped_syncs):
             for machine_id, sync_infos in groupby(skipped_syncs, key=lambda item: item[0]):
@@ -75,4 +168,23 @@ class MobileSync(PlexiglasPlugin):
                 for m in downloaded_media:
                     required_media.append((machine_id, m['media_id']))
 
-        return required_media
+        return SyncPlan(required_media, jobs)
+
+    @classmethod
+    def sync(cls, plex, opts):
+        plan = cls.plan(plex, opts)
+        execute_plans(plex, opts, [plan], get_disk_used(opts))
+        return plan.required_media
+
+    @classmethod
+    def register_options(cls, parser):
+        g = parser.add_argument_group(title='Mobile sync')
+        g.add_argument('--mobile-sync-concurrency', type=int, metavar='int', default=4,
+                       help='Count of sync items to request media lists for simultaneously (default %(default)d)')
+        g.add_argument('--transcode-poll-min-delay', type=int, metavar='seconds', default=10,
+                       help='Minimal delay between the checks of the items being transcoded by the server, the next '
+                            'iteration starts as soon as some of them are ready (only with --loop, 0 to disable, '
+                            'default %(default)d)')
+        g.add_argument('--transcode-poll-max-delay', type=int, metavar='seconds', default=300,
+                       help='Maximal delay between the checks of the items being transcoded by the server '
+                            '(default %(default)d)')
@@ -0,0 +1,167 @@
+from . import log
+from .content import sync_dirname
+from .scheduler import create_scheduler
+
+
+DOWNLOAD_ORDERS = ('server', 'oldest', 'smallest')
+
+# Total bonus of all the jobs for their positions in the list, see `select_jobs`
+RANK_BONUS = 0.01
+
+
+class SyncPlan(object):
+    """
+    Result of `plan()` of a plugin: the media required by the plugin (see `content.cleanup`), the jobs to download
+    and an optional callback, which is called after all the selected jobs are finished.
+
+    `prefetch_jobs` are the downloads of the media, which are expected to be required soon: they are started after all
+    the other jobs and only within the budget left by them, in the given order. Their media should be listed in
+    `required_media` as well, so they are not removed by the cleanup.
+    """
+
+    __slots__ = ['required_media', 'jobs', 'on_complete', 'prefetch_jobs']
+
+    def __init__(self, required_media=None, jobs=None, on_complete=None, prefetch_jobs=None):
+        self.required_media = required_media if required_media is not None else []
+        self.jobs = jobs if jobs is not None else []
+        self.on_complete = on_complete
+        self.prefetch_jobs = prefetch_jobs if prefetch_jobs is not None else []
+
+
+def parse_sync_weights(values):
+    """ Parses the list of `TITLE=WEIGHT` strings into a dict. """
+    weights = {}
+    for value in values:
+        title, weight = value.rsplit('=', 1)
+        weights[sync_dirname(title.strip())] = float(weight)
+
+    return weights
+
+
+def _media_date(media):
+    for attr in ('originallyAvailableAt', 'addedAt'):
+        value = getattr(media, attr, None)
+        if value is not None:
+            return value.timetuple()
+
+    return None
+
+
+def _is_watched(media):
+    return bool(getattr(media, 'viewCount', 0) or getattr(media, 'isWatched', False))
+
+
+def order_jobs(jobs, order):
+    """ Returns the jobs sorted according to `--download-order`, the sort is stable, so `server` keeps the order. """
+    if order == 'smallest':
+        return sorted(jobs, key=lambda j: j.size)
+
+    if order == 'oldest':
+        def key(job):
+            date = _media_date(job.media)
+            return _is_watched(job.media), date is None, date
+
+        return sorted(jobs, key=key)
+
+    return list(jobs)
+
+
+def knapsack(sizes, values, budget, max_cells=5000000):
+    """
+    Returns indexes of the items with the maximal total value, which fit into the budget. The sizes are rounded up
+    to the units of `budget / capacity` bytes, where the capacity is chosen to keep the table within `max_cells`, so
+    the result always fits, but may be slightly suboptimal.
+    """
+    count = len(sizes)
+    if not count or budget <= 0:
+        return []
+
+    capacity = int(max(1, min(budget, max_cells // count)))
+    unit = -(-budget // capacity)
+    capacity = budget // unit
+    weights = [-(-size // unit) for size in sizes]
+
+    best = [0.0] * (capacity + 1)
+    taken = []
+    for weight, value in zip(weights, values):
+        row = bytearray(capacity + 1)
+        for c in range(capacity, weight - 1, -1):
+            candidate = best[c - weight] + value
+            if candidate > best[c]:
+                best[c] = candidate
+                row[c] = 1
+        taken.append(row)
+
+    selected = []
+    c = capacity
+    for idx in range(count - 1, -1, -1):
+        if taken[idx][c]:
+            selected.append(idx)
+            c -= weights[idx]
+
+    return sorted(selected)
+
+
+def select_jobs(jobs, budget, sync_weights=None):
+    """
+    Selects the jobs to download within the budget. Every job is worth its sync's weight (1 by default), so the total
+    weight, i.e. the count of downloaded items, is maximized first; among the selections of the same total weight the
+    items in the beginning of the list are preferred. The rank bonuses of all the jobs sum up to `RANK_BONUS`, so they
+    never outweigh a difference in the total weight bigger than that.
+
+    :param jobs: list of DownloadJob, ordered by priority
+    :param budget: amount of bytes available for the downloads, None means unlimited
+    :return: selected jobs, in the same order
+    """
+    if budget is None or sum(j.size for j in jobs) <= budget:
+        return list(jobs)
+
+    sync_weights = sync_weights or {}
+    count = len(jobs)
+    # sum(count - rank for rank in range(count)) == count * (count + 1) / 2
+    bonus_unit = RANK_BONUS * 2 / (count * (count + 1))
+    values = []
+    for rank, job in enumerate(jobs):
+        weight = sync_weights.get(sync_dirname(job.sync_title), 1.0)
+        values.append(weight + bonus_unit * (count - rank))
+
+    return [jobs[idx] for idx in knapsack([j.size for j in jobs], values, budget)]
+
+
+def select_prefetch_jobs(jobs, budget):
+    """ Selects the prefetch jobs greedily, in their order, which fit into the budget. """
+    selected = []
+    for job in jobs:
+        if job.size <= budget:
+            selected.append(job)
+            budget -= job.size
+
+    return selected
+
+
+def execute_plans(plex, opts, plans, disk_used):
+    """
+    Downloads the jobs of all the plans with a single scheduler: the jobs are ordered according to `--download-order`
+    and a subset fitting into the disk budget is selected before any download is started.
+    """
+    scheduler = create_scheduler(plex, opts, disk_used)
+
+    jobs = order_jobs([j for p in plans for j in p.jobs], opts.download_order)
+    selected = select_jobs(jobs, scheduler.budget(), opts.sync_weight)
+
+    if len(selected) < len(jobs):
+        log.info('%d of %d files fit into the disk budget', len(selected), len(jobs))
+
+    prefetch = select_prefetch_jobs([j for p in plans for j in p.prefetch_jobs],
+                                    scheduler.budget() - sum(j.size for j in selected))
+    if prefetch:
+        log.info('Prefetching %d files', len(prefetch))
+
+    for job in selected + prefetch:
+        scheduler.submit(job)
+
+    scheduler.join()
+
+    for plan in plans:
+        if plan.on_complete is not None:
+            plan.on_complete()
@@ -1,8 +1,19 @@
-from . import db, log
+import threading
+from time import time
+
+from . import db, log, metrics
 
 
 PLEXAPI_INITIALIZED = False
 
+_account = None
+_resources = None
+_resources_loaded_at = 0
+_servers = {}
+_pool_size = 10
+_metadata_cache = None
+_lock = threading.RLock()
+
 
 def init_sync_target():
     import plexapi
@@ -48,22 +59,122 @@ def init_plexapi(device_name):
     PLEXAPI_INITIALIZED = True
 
 
+def _mount_adapter(session, pool_size=None):
+    from requests.adapters import HTTPAdapter
+
+    pool_size = pool_size or _pool_size
+
+    if _metadata_cache is not None:
+        from .http_cache import CachingHTTPAdapter
+        adapter = CachingHTTPAdapter(_metadata_cache, pool_connections=pool_size, pool_maxsize=pool_size)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if metrics.count_response not in session.hooks['response']:
+        session.hooks['response'].append(metrics.count_response)
+
+    return session
+
+
+def create_session(pool_size=None):
+    """ Returns requests session with a connection pool big enough to serve all the simultaneous downloads. """
+    from requests import Session
+
+    return _mount_adapter(Session(), pool_size)
+
+
 def get_plex_client(opts):
+    """ Returns MyPlexAccount, the sign in is performed only once per process. """
+    global _account, _pool_size, _metadata_cache
+
     from . import keyring
 
-    init_plexapi(opts.device_name)
+    with _lock:
+        if _account is not None:
+            return _account
+
+        init_plexapi(opts.device_name)
+
+        _pool_size = max(_pool_size, opts.parallel_downloads * opts.download_segments + 2)
+
+        if opts.metadata_cache_size > 0:
+            from .http_cache import MetadataCache
+            _metadata_cache = MetadataCache(opts.metadata_cache_ttl, opts.metadata_cache_size)
+
+        plex = None
+
+        token = keyring.get_password('plexiglas', 'token_' + opts.username)
+        if opts.username and opts.password:
+            log.debug('Password-based')
+            from plexapi.myplex import MyPlexAccount
+            plex = MyPlexAccount(opts.username, opts.password, session=create_session())
+            keyring.set_password('plexiglas', 'token_' + opts.username, plex.authenticationToken)
+        elif opts.username and token:
+            log.debug('Token-based')
+            from plexapi.myplex import MyPlexAccount
+            plex = MyPlexAccount(opts.username, token=token, session=create_session())
+
+        _account = plex
+
+        return plex
+
+
+def get_metadata_cache():
+    """ Returns MetadataCache used by all the sessions, or None if the cache is disabled. """
+    return _metadata_cache
+
+
+def get_resources(plex, ttl=3600):
+    """ Returns the list of resources available for the account, the list is re-requested once in `ttl` seconds. """
+    global _resources, _resources_loaded_at
+
+    with _lock:
+        if _resources is None or time() - _resources_loaded_at > ttl:
+            log.debug('Requesting resources list')
+            with metrics.phase('resources'):
+                _resources = plex.resources()
+            _resources_loaded_at = time()
+
+        return _resources
+
+
+def get_server(plex, machine_id, ttl=3600):
+    """ Returns connected PlexServer by its machine id or None, if the server is not found within the resources.
+        The connection is established once and reused afterwards.
+    """
+    with _lock:
+        if machine_id in _servers:
+            return _servers[machine_id]
+
+        resource = None
+        for r in get_resources(plex, ttl):
+            if r.clientIdentifier == machine_id:
+                resource = r
+                break
+
+    if resource is None:
+        return None
+
+    log.debug('Connecting to server %s', machine_id)
+    server = resource.connect()
+    _mount_adapter(server._session)
+
+    with _lock:
+        return _servers.setdefault(machine_id, server)
+
+
+def get_connected_servers():
+    """ Returns the list of PlexServers connected by `get_server`. """
+    with _lock:
+        return list(_servers.values())
 
-    plex = None
 
-    token = keyring.get_password('plexiglas', 'token_' + opts.username)
-    if opts.username and opts.password:
-        log.debug('Password-based')
-        from plexapi.myplex import MyPlexAccount
-        plex = MyPlexAccount(opts.username, opts.password)
-        keyring.set_password('plexiglas', 'token_' + opts.username, plex.authenticationToken)
-    elif opts.username and token:
-        log.debug('Token-based')
-        from plexapi.myplex import MyPlexAccount
-        plex = MyPlexAccount(opts.username, token=token)
+def reset_connections():
+    """ Forgets all the established servers connections and the resources list, the account is kept. """
+    global _resources
 
-    return plex
+    with _lock:
+        _servers.clear()
+        _resources = None
@@ -33,7 +33,14 @@ class PlexiglasPlugin:
         def process_options(cls, opts)
 
     Synchronization:
+        def plan(cls, plex, opts, trigger=None): planner.SyncPlan
         def sync(cls, plex, opts): list
+
+    When `plan` is implemented, the jobs of all the plugins are downloaded together, in the order of their priority
+    and within the disk budget; otherwise `sync` is called, which should perform the downloads itself.
+
+    With `--watch-events` the `trigger` (events.SyncTrigger) describes what has changed since the previous iteration,
+    so the unaffected syncs may be skipped; None means everything should be checked.
     """
 
     @abc.abstractproperty
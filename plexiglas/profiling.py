@@ -0,0 +1,105 @@
+"""
+`--profile` mode: every phase of an iteration is timed and a summary table is logged once the iteration is over.
+With `--profile-dir` the main thread is also profiled with cProfile, one `.pstats` file per iteration.
+"""
+
+import os
+from contextlib import contextmanager
+from time import strftime, time
+
+from humanfriendly import format_size
+
+from . import log, metrics
+
+
+_COUNTERS = (
+    ('requests', 'plexiglas_http_requests_total'),
+    ('metadata', 'plexiglas_metadata_bytes_total'),
+    ('downloaded', 'plexiglas_downloaded_bytes_total'),
+    ('queries', 'plexiglas_db_queries_total'),
+)
+
+
+def _snapshot():
+    return dict((name, metrics.get_value(metric)) for name, metric in _COUNTERS)
+
+
+def _count_query(statement):
+    metrics.inc('plexiglas_db_queries_total')
+
+
+class IterationProfiler(object):
+    """ Collects wall time, network traffic and count of DB queries of every phase of a single iteration. """
+
+    def __init__(self, enabled=False, profile_dir=None, iteration=0):
+        self.enabled = enabled or bool(profile_dir)
+        self.profile_dir = profile_dir
+        self.iteration = iteration
+        self.phases = []
+        self._profile = None
+        self._begin = None
+        self._begin_counters = None
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        from . import db
+
+        db.set_trace_callback(_count_query)
+
+        self._begin = time()
+        self._begin_counters = _snapshot()
+
+        if self.profile_dir:
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.enabled:
+            return
+
+        if self._profile is not None:
+            self._profile.disable()
+            filename = 'plexiglas-%s-%d.pstats' % (strftime('%Y%m%d-%H%M%S'), self.iteration)
+            path = os.path.join(self.profile_dir, filename)
+            self._profile.dump_stats(path)
+            log.info('Profile of the iteration is saved to %s', path)
+
+        self.phases.append(self._measure('total', self._begin, self._begin_counters))
+        self.log_summary()
+
+    @staticmethod
+    def _measure(name, begin, begin_counters):
+        counters = _snapshot()
+        ret = {'name': name, 'wall': time() - begin}
+        for key, value in counters.items():
+            ret[key] = value - begin_counters[key]
+        return ret
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        begin = time()
+        begin_counters = _snapshot()
+        try:
+            yield
+        finally:
+            self.phases.append(self._measure(name, begin, begin_counters))
+
+    def log_summary(self):
+        width = max([len(p['name']) for p in self.phases] + [5])
+        row = '%-' + str(width) + 's %9s %9s %11s %11s %9s'
+
+        log.info('Iteration #%d profile:', self.iteration)
+        log.info(row, 'Phase', 'Wall, s', 'Requests', 'Metadata', 'Downloaded', 'DB queries')
+        for p in self.phases:
+            log.info(row, p['name'], '%.3f' % p['wall'], p['requests'], format_size(p['metadata'], binary=True),
+                     format_size(p['downloaded'], binary=True), p['queries'])
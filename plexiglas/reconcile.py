@@ -0,0 +1,166 @@
+"""
+Reconciliation of the files within the destination directory with the downloaded items recorded in the DB, based on
+the inventory (see `inventory`), so it doesn't touch the disk by itself.
+
+The files are split into the tracked ones (known to the DB), partial downloads and orphans (everything else: the files
+left by an interrupted cleanup, added by the user, etc). The tracked files are checked for the size recorded in the
+DB, and the DB records are checked for the missing files.
+"""
+
+import os
+
+from humanfriendly import format_size
+
+from . import db, log, metrics
+from .content import get_media_dir, sanitize_filename, sync_dirname
+from .inventory import get_inventory
+
+PARTIAL_SUFFIXES = ('.part', '.part.segments')
+DB_FILES = ('.plexiglas.db', '.plexiglas.db-wal', '.plexiglas.db-shm', '.plexiglas.db-journal')
+
+_last_summary = None
+
+
+class ReconcileReport(object):
+    __slots__ = ['total_bytes', 'tracked_bytes', 'db_bytes', 'partial_bytes', 'orphans', 'missing', 'mismatched']
+
+    def __init__(self):
+        self.total_bytes = 0
+        self.tracked_bytes = 0
+        self.db_bytes = 0
+        self.partial_bytes = 0
+        # (path, size)
+        self.orphans = []
+        # path
+        self.missing = []
+        # (path, size according to the DB, actual size)
+        self.mismatched = []
+
+    @property
+    def orphaned_bytes(self):
+        return sum(size for _, size in self.orphans)
+
+
+def get_own_files(opts, inventory):
+    """ Returns the set of the paths of the files written by plexiglas for itself: the DB, the metrics and the log
+        with its backups.
+    """
+    own_files = set(os.path.join(inventory.root, name) for name in DB_FILES)
+    if getattr(opts, 'metrics_textfile', None):
+        own_files.add(os.path.abspath(opts.metrics_textfile))
+
+    if getattr(opts, 'log_file', None):
+        log_file = os.path.abspath(opts.log_file)
+        own_files.add(log_file)
+        for i in range(1, int(getattr(opts, 'log_file_backups', 0) or 0) + 1):
+            own_files.add('%s.%d' % (log_file, i))
+
+    return own_files
+
+
+def get_own_dirs(opts):
+    """ Returns the tuple of the prefixes of the directories written by plexiglas for itself: the profiles. """
+    own_dirs = []
+    if getattr(opts, 'profile_dir', None):
+        own_dirs.append(os.path.join(os.path.abspath(opts.profile_dir), ''))
+
+    return tuple(own_dirs)
+
+
+def is_own_file(path, own_files, own_dirs):
+    return path in own_files or path.startswith(own_dirs)
+
+
+def reconcile(opts):
+    """ Reconciles the inventory of the destination directory with the DB, updates the metrics and logs the result.
+
+    :rtype: ReconcileReport
+    """
+    inventory = get_inventory(opts.destination)
+    files = dict(inventory.get_files())
+    own_files = get_own_files(opts, inventory)
+    own_dirs = get_own_dirs(opts)
+
+    report = ReconcileReport()
+    report.total_bytes = sum(size for path, size in files.items() if not is_own_file(path, own_files, own_dirs))
+
+    dirnames = {}
+    for row in db.get_all_downloaded():
+        if row['sync_title'] not in dirnames:
+            dirnames[row['sync_title']] = sync_dirname(row['sync_title'])
+
+        media_filename = sanitize_filename(row['media_filename'])
+        path = os.path.join(get_media_dir(opts, dirnames[row['sync_title']], row['media_type'], media_filename),
+                            media_filename)
+        db_size = row['filesize'] or 0
+        report.db_bytes += db_size
+
+        size = files.pop(path, None)
+        if size is None:
+            report.missing.append(path)
+            continue
+
+        report.tracked_bytes += size
+        if size != db_size:
+            report.mismatched.append((path, db_size, size))
+
+    for path, size in files.items():
+        if path.endswith(PARTIAL_SUFFIXES):
+            report.partial_bytes += size
+        elif not is_own_file(path, own_files, own_dirs):
+            report.orphans.append((path, size))
+
+    metrics.set_value('plexiglas_partial_bytes', report.partial_bytes)
+    metrics.set_value('plexiglas_orphaned_bytes', report.orphaned_bytes)
+    metrics.set_value('plexiglas_orphaned_files', len(report.orphans))
+    metrics.set_value('plexiglas_missing_files', len(report.missing))
+    metrics.set_value('plexiglas_size_mismatch_files', len(report.mismatched))
+
+    log_report(report)
+
+    return report
+
+
+def log_report(report):
+    """ Logs the report, with INFO level only when the orphans or the size mismatches have changed since last time. """
+    global _last_summary
+
+    log.debug('Destination directory contains %s, %s of them are tracked by the DB (%s recorded), %s are partial '
+              'downloads, %s are orphaned', format_size(report.total_bytes, binary=True),
+              format_size(report.tracked_bytes, binary=True), format_size(report.db_bytes, binary=True),
+              format_size(report.partial_bytes, binary=True), format_size(report.orphaned_bytes, binary=True))
+
+    summary = (tuple(sorted(p for p, _ in report.orphans)), tuple(sorted(p for p, _, _ in report.mismatched)))
+    if summary == _last_summary:
+        return
+    _last_summary = summary
+
+    for path, size in sorted(report.orphans):
+        log.debug('Orphaned file %s (%s)', path, format_size(size, binary=True))
+
+    for path, db_size, size in sorted(report.mismatched):
+        log.debug('File %s has size %d, while %d is recorded in the DB', path, size, db_size)
+
+    if report.orphans or report.mismatched:
+        log.info('Found %d files (%s) unknown to the DB and %d files with a size different from the DB',
+                 len(report.orphans), format_size(report.orphaned_bytes, binary=True), len(report.mismatched))
+
+
+def get_disk_used(opts):
+    """
+    Returns the disk usage to be checked against `--limit-disk-usage`: the size of all the files within the destination
+    directory (except the own files of plexiglas), or the size of the downloaded files according to the DB with
+    `--disk-usage-source db`.
+
+    The partial downloads are never counted: the job resuming a partial download reserves its whole size anyway, and
+    a segmented `.part` file has the full size right from the start.
+    """
+    if getattr(opts, 'disk_usage_source', 'db') == 'db':
+        return db.get_downloaded_size()
+
+    inventory = get_inventory(opts.destination)
+    own_files = get_own_files(opts, inventory)
+    own_dirs = get_own_dirs(opts)
+
+    return sum(size for path, size in inventory.get_files()
+               if not is_own_file(path, own_files, own_dirs) and not path.endswith(PARTIAL_SUFFIXES))
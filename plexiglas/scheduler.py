@@ -0,0 +1,224 @@
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+from . import log, metrics
+from .content import download_media, get_available_disk_space
+
+
+class DownloadJob(object):
+    __slots__ = ['sync_title', 'media', 'part', 'callback', 'max_allowed_size_diff_percent']
+
+    def __init__(self, sync_title, media, part, callback, max_allowed_size_diff_percent=0):
+        """
+        :param sync_title: title of the sync, used as a destination directory
+        :type sync_title: str
+        :param media:
+        :type media: plexapi.base.Playable
+        :param part:
+        :type part: plexapi.media.MediaPart
+        :param callback: called as `callback(media, part, filename, checksum)` right before the `.part` file is
+            renamed
+        :param max_allowed_size_diff_percent: see `content.download_media`
+        """
+        self.sync_title = sync_title
+        self.media = media
+        self.part = part
+        self.callback = callback
+        self.max_allowed_size_diff_percent = max_allowed_size_diff_percent
+
+    @property
+    def size(self):
+        return self.part.size
+
+
+class DownloadScheduler(object):
+    """
+    Bounded worker pool for downloading media parts.
+
+    The scheduler owns disk usage accounting for the jobs submitted to it: every accepted job reserves its size
+    until it fails, so the jobs which are still in flight are taken into account by the `--limit-disk-usage` and
+    available disk space checks. The available space is requested from the filesystem only once, when the first
+    job is submitted, and is tracked locally afterwards.
+
+    With a single worker (the default) the jobs are executed right away in the calling thread.
+    """
+
+    def __init__(self, plex, opts, disk_used=0):
+        self.plex = plex
+        self.opts = opts
+        self.workers = max(1, int(getattr(opts, 'parallel_downloads', 1) or 1))
+        self.disk_used = disk_used
+        self._reserved = 0
+        self._available = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._exc_info = None
+
+    def limit_exceeded(self):
+        with self._lock:
+            return bool(self.opts.limit_disk_usage) and self.disk_used + self._reserved > self.opts.limit_disk_usage
+
+    def budget(self):
+        """ Returns amount of bytes, which may be downloaded without exceeding the disk limits. """
+        with self._lock:
+            if self._available is None:
+                self._available = get_available_disk_space(self.opts.destination)
+
+            budget = self._available - self._reserved
+            if self.opts.limit_disk_usage:
+                budget = min(budget, self.opts.limit_disk_usage - self.disk_used - self._reserved)
+
+            return max(0, int(budget))
+
+    def _reserve(self, job):
+        with self._lock:
+            if self.opts.limit_disk_usage and self.disk_used + self._reserved + job.size > self.opts.limit_disk_usage:
+                log.debug('Not downloading %s from %s, size limit would be exceeded', job.media.title, job.sync_title)
+                return False
+
+            if self._available is None:
+                self._available = get_available_disk_space(self.opts.destination)
+
+            if self._available - self._reserved < job.size:
+                log.debug('Not downloading %s from %s, due to low available space', job.media.title, job.sync_title)
+                return False
+
+            self._reserved += job.size
+            metrics.inc('plexiglas_download_queue_depth')
+            return True
+
+    def _release(self, job, failed):
+        metrics.inc('plexiglas_download_queue_depth', -1)
+        if failed:
+            metrics.inc('plexiglas_download_failures_total')
+            with self._lock:
+                self._reserved -= job.size
+        else:
+            metrics.inc('plexiglas_downloaded_files_total')
+
+    def submit(self, job):
+        """
+        Schedule the job for downloading. Returns False if the job doesn't fit into the disk limits.
+
+        :type job: DownloadJob
+        :rtype: bool
+        """
+        if not self._reserve(job):
+            return False
+
+        if self.workers == 1:
+            self._run(job)
+        else:
+            self._start_workers()
+            self._queue.put(job)
+
+        return True
+
+    def _run(self, job):
+        failed = True
+        try:
+            download_media(self.plex, job.sync_title, job.media, job.part, self.opts, job.callback,
+                           job.max_allowed_size_diff_percent)
+            failed = False
+        finally:
+            self._release(job, failed)
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name='plexiglas-download-%d' % len(self._threads))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+
+                if self._exc_info is not None:
+                    # Some download has already failed, the error will be re-raised in join(); skip the rest
+                    self._release(job, True)
+                    continue
+
+                try:
+                    self._run(job)
+                except BaseException:
+                    log.debug('Download of %s failed', job.media.title, exc_info=True)
+                    with self._lock:
+                        if self._exc_info is None:
+                            self._exc_info = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """
+        Wait for all the submitted jobs to finish and stop the workers. Re-raises the first error occurred in
+        a worker.
+        """
+        if self._threads:
+            self._queue.join()
+            for _ in self._threads:
+                self._queue.put(None)
+            for t in self._threads:
+                t.join()
+            self._threads = []
+
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            six.reraise(*exc_info)
+
+
+def create_scheduler(plex, opts, disk_used=0):
+    """ Returns the scheduler for the download backend selected with `--download-backend`. """
+    if getattr(opts, 'download_backend', 'threads') == 'asyncio':
+        from .async_download import AsyncDownloadScheduler
+
+        return AsyncDownloadScheduler(plex, opts, disk_used)
+
+    return DownloadScheduler(plex, opts, disk_used)
+
+
+def parallel_map(func, items, workers):
+    """
+    Returns `[func(item) for item in items]`, calling `func` in up to `workers` threads. The first exception raised
+    by `func` is re-raised after all the threads are finished.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    exc_info = []
+    tasks = queue.Queue()
+    for task in enumerate(items):
+        tasks.put(task)
+
+    def worker():
+        while not exc_info:
+            try:
+                idx, item = tasks.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                results[idx] = func(item)
+            except BaseException:
+                exc_info.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if exc_info:
+        six.reraise(*exc_info[0])
+
+    return results
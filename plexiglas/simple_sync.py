@@ -1,12 +1,19 @@
 from keyring.util.properties import ClassProperty
 
-from plexiglas.content import download_media
+from plexiglas.events import get_section_id
+from plexiglas.plex import get_server
+from plexiglas.planner import SyncPlan, execute_plans
 from plexiglas.plugin import PlexiglasPlugin
+from plexiglas.reconcile import get_disk_used
+from plexiglas.scheduler import DownloadJob, parallel_map
 import argparse
 from plexiglas import log, db
 from six.moves.urllib.parse import urlparse, parse_qsl, urlencode
 from hashlib import md5
+from itertools import chain, islice
+from time import time
 from plexapi import video, audio
+from plexapi.exceptions import BadRequest
 
 
 class SimpleSync(PlexiglasPlugin):
@@ -21,115 +28,287 @@ class SimpleSync(PlexiglasPlugin):
             return part
 
     @classmethod
-    def sync(cls, plex, opts):
+    def iter_items(cls, server, key, page_size):
+        """ Yields the items of the container, fetching them page by page. """
+        start = 0
+        first_keys = set()
+        while True:
+            data = server.query(key, headers={'X-Plex-Container-Start': str(start),
+                                              'X-Plex-Container-Size': str(page_size)})
+            if data is None or not len(data):
+                return
+
+            # A server ignoring the paging headers returns the whole container every time
+            first_key = data[0].attrib.get('ratingKey') or data[0].attrib.get('key')
+            if first_key is not None:
+                if first_key in first_keys:
+                    log.debug('Got the page of %s starting at %d once again, paging is not supported', key, start)
+                    return
+                first_keys.add(first_key)
+
+            library_section_id = data.attrib.get('librarySectionID')
+            for item in server.findItems(data, initpath=key):
+                if library_section_id:
+                    item.librarySectionID = library_section_id
+                yield item
+
+            start += len(data)
+            total_size = data.attrib.get('totalSize')
+            if total_size is None:
+                if len(data) != page_size:
+                    return
+            elif start >= int(total_size):
+                return
+
+    @classmethod
+    def mark_downloaded_callback(cls, machine_id, sync_id, sync_title):
+        def mark_downloaded(media, part, filename, checksum=None):
+            db.mark_downloaded(machine_id, cls.name, sync_id, sync_title, media, part.size, filename,
+                               checksum=checksum)
+
+        return mark_downloaded
+
+    @classmethod
+    def get_server_watermark(cls, server):
+        """
+        Returns a string, which changes when anything is added to / updated in any library section of the server, or
+        when anything is watched. None is returned if the server doesn't allow to track the changes.
+        """
+        parts = []
+
+        sections = server.query('/library/sections', headers={'Cache-Control': 'no-cache'})
+        for s in sections if sections is not None else []:
+            parts.append('%s:%s' % (s.attrib.get('key'), s.attrib.get('updatedAt')))
+
+        try:
+            history = server.query('/status/sessions/history/all?sort=viewedAt:desc',
+                                   headers={'X-Plex-Container-Start': '0', 'X-Plex-Container-Size': '1',
+                                            'Cache-Control': 'no-cache'})
+        except BadRequest:
+            log.debug('Unable to fetch watch history from %s, incremental sync is disabled', server.friendlyName)
+            return None
+
+        for h in history if history is not None else []:
+            parts.append('%s:%s' % (h.attrib.get('ratingKey'), h.attrib.get('viewedAt')))
+
+        return '|'.join(parts)
+
+    @classmethod
+    def get_watermark(cls, server, key, server_watermark):
+        """ Returns the watermark for the key, based on its container size, its first element and server watermark. """
+        if server_watermark is None:
+            return None
+
+        data = server.query(key, headers={'X-Plex-Container-Start': '0', 'X-Plex-Container-Size': '1',
+                                          'Cache-Control': 'no-cache'})
+        if data is None:
+            return None
+
+        parts = [server_watermark, data.attrib.get('totalSize', data.attrib.get('size', ''))]
+        for elem in data:
+            for attr in ('ratingKey', 'updatedAt', 'leafCount', 'viewedLeafCount', 'lastViewedAt'):
+                parts.append(elem.attrib.get(attr, ''))
+
+        return md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_required_prefix(cls, target_media, limit):
+        """
+        Returns the media of the target stored in its sync state, which have to be downloaded for the target to be
+        considered unchanged: the ones after the limit are prefetched, so they may not fit into the disk limits.
+        """
+        return target_media[:limit] if limit > -1 else target_media
+
+    @classmethod
+    def plan_target(cls, plex, opts, target, server_watermarks, trigger=None):
+        """
+        Resolves the server and lists the items for a single --simple-sync-url target.
+
+        :return: required media, list of (machine_id, DownloadJob) to download, list of (machine_id, DownloadJob) to
+            prefetch, whether the target is being watched right now and the state to be stored in the DB after the
+            downloads, if any
+        """
+        url = target[0]
+        limit = target[1] if len(target) > 1 else -1
+        unwatched_only = bool(target[2] if len(target) > 2 else 1)
+        log.debug('Processing %s, with limit=%d, unwatched_only=%d', url, limit, unwatched_only)
+
+        parsed_url = urlparse(url)
+
+        if parsed_url.fragment[0] == '!' and '/server/' in parsed_url.fragment and 'key=' in parsed_url.fragment:
+            parsed_url = urlparse(parsed_url.fragment)
+
+        qs = dict(parse_qsl(parsed_url.query))
+        splitted_url = parsed_url.path.split('/')
+
+        machine_id = None
+        for idx, value in enumerate(splitted_url):
+            if value == 'server' and len(splitted_url) > idx + 1:
+                machine_id = splitted_url[idx + 1]
+                break
+
+        if machine_id is None:
+            raise ValueError('Unable to determinate server id for URL %s', url)
+
+        server = get_server(plex, machine_id, opts.resources_ttl)
+
+        if server is None:
+            raise ValueError('Unable to find required server in your MyPlex account')
+
+        key = qs.pop('typeKey', qs.pop('key'))
+        qs.pop('save', None)
+
+        if qs.get('filters'):
+            if '?' in key:
+                key += '&'
+            else:
+                key += '?'
+
+            key += qs.pop('filters')
+
+        if len(qs):
+            if '?' in key:
+                key += '&'
+            else:
+                key += '?'
+            key += urlencode(qs)
+
+        sync_id = md5(key.encode('utf-8')).hexdigest()
+
+        all_downloaded_media = set(r['media_id'] for r in db.get_downloaded_for_sync_type(machine_id, cls.name))
+
+        if trigger is not None and not trigger.affects_section(machine_id, get_section_id(key)):
+            state = db.get_sync_state(machine_id, cls.name, sync_id)
+            if state is not None and all_downloaded_media.issuperset(cls.get_required_prefix(state[1], limit)):
+                log.debug('%s is not affected by the changes, skipping', url)
+                return [(machine_id, media_id) for media_id in state[1]], [], [], False, None
+
+        watermark = None
+        if opts.simple_sync_full_scan_interval > 0:
+            if machine_id not in server_watermarks:
+                server_watermarks[machine_id] = cls.get_server_watermark(server)
+            watermark = cls.get_watermark(server, key, server_watermarks[machine_id])
+
+            state = db.get_sync_state(machine_id, cls.name, sync_id)
+            if watermark is not None and state is not None:
+                state_watermark, state_required_media, full_scan_at = state
+                if state_watermark == watermark \
+                        and all_downloaded_media.issuperset(cls.get_required_prefix(state_required_media, limit)) \
+                        and time() - full_scan_at < opts.simple_sync_full_scan_interval:
+                    log.debug('No changes for %s since the last scan', url)
+                    return [(machine_id, media_id) for media_id in state_required_media], [], [], False, None
+
+        items_list = cls.iter_items(server, key, opts.simple_sync_page_size)
+        first_items = list(islice(items_list, 2))
+        items_list = chain(first_items, items_list)
+
+        section = None
+
+        if len(first_items) == 1 and type(first_items[0]) in (video.Show, video.Season):
+            root = first_items[0]
+            if unwatched_only:
+                items_list = root.unwatched()
+            else:
+                items_list = root.episodes()
+
+            if isinstance(root, video.Show):
+                section = root
+            elif isinstance(root, video.Season):
+                section = root.show()
+        elif len(first_items) == 1 and type(first_items[0]) in (audio.Artist, audio.Album):
+            root = first_items[0]
+            items_list = root.tracks()
+
+            if isinstance(root, audio.Artist):
+                section = root
+            elif isinstance(root, audio.Album):
+                section = root.show()
+
+        prefetch_count = opts.simple_sync_prefetch if limit > -1 and unwatched_only else 0
+
+        target_media = []
+        jobs = []
+        prefetch_jobs = []
+        watching = False
+        downloaded_count = 0
+        for item in items_list:
+            prefetch = -1 < limit <= downloaded_count
+            if prefetch and downloaded_count - limit == prefetch_count:
+                log.debug('Reached download limit, aborting')
+                break
+
+            if isinstance(item, video.Video) and item.isWatched and unwatched_only:
+                continue
+
+            target_media.append(item.ratingKey)
+
+            downloaded_count += 1
+            if not prefetch and getattr(item, 'viewOffset', 0):
+                watching = True
+
+            if item.ratingKey in all_downloaded_media:
+                continue
+
+            if section is None:
+                section = item.section()
+
+            part = cls.get_download_part(item)
+            max_allowed_size_diff_percent = 0
+            if isinstance(item, audio.Track):
+                # Plex removes some tags from audio file, so the size may be a little lower, than expected
+                max_allowed_size_diff_percent = 1
+            mark_downloaded = cls.mark_downloaded_callback(machine_id, sync_id, section.title)
+            job = DownloadJob(section.title, item, part, mark_downloaded, max_allowed_size_diff_percent)
+            (prefetch_jobs if prefetch else jobs).append((machine_id, job))
+
+        sync_state = None
+        if watermark is not None:
+            sync_state = (machine_id, sync_id, watermark, target_media)
+
+        return [(machine_id, media_id) for media_id in target_media], jobs, prefetch_jobs, watching, sync_state
+
+    @classmethod
+    def plan(cls, plex, opts, trigger=None):
+        server_watermarks = {}
+
+        plans = parallel_map(lambda target: cls.plan_target(plex, opts, target, server_watermarks, trigger),
+                             opts.simple_sync_url, opts.simple_sync_concurrency)
+
         required_media = []
+        jobs = []
+        prefetch_jobs = []
+        scheduled_media = set()
 
-        for target in opts.simple_sync_url:
-            url = target[0]
-            limit = target[1] if len(target) > 1 else -1
-            unwatched_only = bool(target[2] if len(target) > 2 else 1)
-            log.debug('Processing %s, with limit=%d, unwatched_only=%d', url, limit, unwatched_only)
-
-            parsed_url = urlparse(url)
-
-            if parsed_url.fragment[0] == '!' and '/server/' in parsed_url.fragment and 'key=' in parsed_url.fragment:
-                parsed_url = urlparse(parsed_url.fragment)
-
-            qs = dict(parse_qsl(parsed_url.query))
-            splitted_url = parsed_url.path.split('/')
-
-            machine_id = None
-            for idx, value in enumerate(splitted_url):
-                if value == 'server' and len(splitted_url) > idx + 1:
-                    machine_id = splitted_url[idx + 1]
-                    break
-
-            if machine_id is None:
-                raise ValueError('Unable to determinate server id for URL %s', url)
-
-            server = None
-            for resource in plex.resources():
-                if resource.clientIdentifier == machine_id:
-                    server = resource.connect()
-
-            if server is None:
-                raise ValueError('Unable to find required server in your MyPlex account')
-
-            key = qs.pop('typeKey', qs.pop('key'))
-            qs.pop('save', None)
-
-            if qs.get('filters'):
-                if '?' in key:
-                    key += '&'
-                else:
-                    key += '?'
-
-                key += qs.pop('filters')
-
-            if len(qs):
-                if '?' in key:
-                    key += '&'
-                else:
-                    key += '?'
-                key += urlencode(qs)
-
-            sync_id = md5(key.encode('utf-8')).hexdigest()
-
-            all_downloaded_media = [r['media_id'] for r in db.get_downloaded_for_sync_type(machine_id, cls.name)]
-            items_list = server.fetchItems(key)
-
-            section = None
-
-            def mark_downloaded(media, part, filename):
-                db.mark_downloaded(machine_id, cls.name, sync_id, section.title, media, part.size, filename)
-
-            if len(items_list) == 1 and type(items_list[0]) in (video.Show, video.Season):
-                root = items_list[0]
-                if unwatched_only:
-                    items_list = root.unwatched()
-                else:
-                    items_list = root.episodes()
-
-                if isinstance(root, video.Show):
-                    section = root
-                elif isinstance(root, video.Season):
-                    section = root.show()
-            elif len(items_list) == 1 and type(items_list[0]) in (audio.Artist, audio.Album):
-                root = items_list[0]
-                items_list = root.tracks()
-
-                if isinstance(root, audio.Artist):
-                    section = root
-                elif isinstance(root, audio.Album):
-                    section = root.show()
-
-            downloaded_count = 0
-            for item in items_list:
-                if -1 < limit == downloaded_count:
-                    log.debug('Reached download limit, aborting')
-                    break
-
-                if isinstance(item, video.Video) and item.isWatched and unwatched_only:
+        def schedule(target_jobs, scheduled):
+            for machine_id, job in target_jobs:
+                if (machine_id, job.media.ratingKey) in scheduled_media:
                     continue
 
-                required_media.append((machine_id, item.ratingKey))
+                scheduled_media.add((machine_id, job.media.ratingKey))
+                scheduled.append(job)
 
-                downloaded_count += 1
+        for target_required_media, target_jobs, _, _, _ in plans:
+            required_media.extend(target_required_media)
+            schedule(target_jobs, jobs)
 
-                if item.ratingKey in all_downloaded_media:
-                    continue
+        # The next items of the targets, which are being watched right now, are the first to be prefetched; the sort
+        # is stable, so the order of the targets is kept otherwise
+        for _, _, target_prefetch_jobs, _, _ in sorted(plans, key=lambda p: not p[3]):
+            schedule(target_prefetch_jobs, prefetch_jobs)
 
-                if section is None:
-                    section = item.section()
+        def save_sync_states():
+            for _, _, _, _, sync_state in plans:
+                if sync_state is not None:
+                    machine_id, sync_id, watermark, target_media = sync_state
+                    db.set_sync_state(machine_id, cls.name, sync_id, watermark, target_media, time())
 
-                part = cls.get_download_part(item)
-                max_allowed_size_diff_percent = 0
-                if isinstance(item, audio.Track):
-                    # Plex removes some tags from audio file, so the size may be a little lower, than expected
-                    max_allowed_size_diff_percent = 1
-                download_media(plex, section.title, item, part, opts, mark_downloaded, max_allowed_size_diff_percent)
+        return SyncPlan(required_media, jobs, save_sync_states, prefetch_jobs)
 
-        return required_media
+    @classmethod
+    def sync(cls, plex, opts):
+        plan = cls.plan(plex, opts)
+        execute_plans(plex, opts, [plan], get_disk_used(opts))
+        return plan.required_media
 
     @classmethod
     def register_options(cls, parser):
@@ -138,6 +317,18 @@ class SimpleSync(PlexiglasPlugin):
                        help='An url from Plex Web with optional limit, provided as integer >= -1, where -1 is '
                             'unlimited, and optional `all` flag, provided as 0 or 1, means to download all content, '
                             'not only unwatched', default=[])
+        g.add_argument('--simple-sync-concurrency', type=int, metavar='int', default=4,
+                       help='Count of URLs to process simultaneously, before starting the downloads '
+                            '(default %(default)d)')
+        g.add_argument('--simple-sync-page-size', type=int, metavar='int', default=50,
+                       help='Count of items to request from the server at once (default %(default)d)')
+        g.add_argument('--simple-sync-prefetch', type=int, metavar='int', default=0,
+                       help='Count of the next unwatched items to download in advance for every URL with a limit, '
+                            'after all the other downloads and only if they fit into the disk limits, so they are '
+                            'already here when the previous ones are watched (default %(default)d)')
+        g.add_argument('--simple-sync-full-scan-interval', type=int, metavar='int', default=3600,
+                       help='When nothing has changed on the server since the last scan the URL is re-scanned only '
+                            'once in this amount of seconds, 0 disables change detection (default %(default)d)')
 
     @classmethod
     def process_options(cls, opts):
@@ -1,77 +1,193 @@
 """
-Copied from https://gist.github.com/drocco007/6155452, thanks @drocco007!
+Based on https://gist.github.com/drocco007/6155452, thanks @drocco007!
 """
 
+import threading
 from time import sleep, time
 
 
+class RateSchedule(object):
+    """Bandwidth limit depending on the time of day, e.g. ``22:00-07:00=unlimited,07:00-22:00=2M``.
+    The periods may wrap around midnight, the bandwidth is not limited outside of the periods.
+    """
+
+    def __init__(self, periods):
+        """periods is a list of (start, end, bandwidth), where start and end are
+        minutes since midnight and bandwidth is None for unlimited."""
+        self.periods = periods
+
+    @classmethod
+    def parse(cls, value):
+        from humanfriendly import parse_size
+
+        def parse_time(t):
+            hours, minutes = t.strip().split(':')
+            if not 0 <= int(hours) <= 24 or not 0 <= int(minutes) < 60:
+                raise ValueError('Unexpected time %s' % t)
+            return int(hours) * 60 + int(minutes)
+
+        periods = []
+        for period in value.split(','):
+            times, bandwidth = period.split('=')
+            start, end = times.split('-')
+            bandwidth = bandwidth.strip()
+            if bandwidth.lower() in ('unlimited', '0'):
+                bandwidth = None
+            else:
+                bandwidth = parse_size(bandwidth, binary=True)
+            periods.append((parse_time(start), parse_time(end), bandwidth))
+
+        return cls(periods)
+
+    def current_rate(self, now=None):
+        """Returns the bandwidth for the given (or current) time, None means unlimited."""
+        from time import localtime
+
+        now = localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+
+        for start, end, bandwidth in self.periods:
+            if start <= end:
+                if start <= minute < end:
+                    return bandwidth
+            elif minute >= start or minute < end:
+                return bandwidth
+
+        return None
+
+
 class TokenBucket(object):
     """An implementation of the token bucket algorithm.
     >>> bucket = TokenBucket(80, 0.5)
-    >>> print bucket.consume(10)
-    True
+    >>> bucket.consume(10)
     adapted from http://code.activestate.com/recipes/511490-implementation-of-the-token-bucket-algorithm/?in=lang-python
-    Not thread safe.
+
+    Thread safe: the bucket may be shared between several downloads, in this case they are limited altogether.
+    Consumers are allowed to take more tokens than available, the bucket goes into debt, and the consumer
+    sleeps until the debt is repaid. Short debts are not slept off immediately, so small chunks don't turn into
+    a lot of tiny sleeps.
+
+    When a schedule is provided both capacity and fill rate follow it, being re-evaluated once in a second,
+    so the consumers speed up or slow down as soon as the schedule says.
     """
 
-    __slots__ = ['capacity', '_tokens', 'fill_rate', 'timestamp']
+    __slots__ = ['capacity', '_tokens', 'fill_rate', 'timestamp', 'min_sleep', '_lock', 'schedule',
+                 '_schedule_checked_at']
 
-    def __init__(self, tokens, fill_rate):
+    def __init__(self, tokens, fill_rate, min_sleep=0.05, schedule=None):
         """tokens is the total tokens in the bucket. fill_rate is the
-        rate in tokens/second that the bucket will be refilled."""
-        self.capacity = float(tokens)
-        self._tokens = float(tokens)
-        self.fill_rate = float(fill_rate)
+        rate in tokens/second that the bucket will be refilled, None means unlimited.
+        min_sleep is the minimal debt (in seconds) which makes consumer to sleep.
+        schedule is a RateSchedule, which overrides tokens and fill_rate."""
+        self.capacity = float(tokens or 0)
+        self._tokens = self.capacity
+        self.fill_rate = float(fill_rate) if fill_rate else None
         self.timestamp = time()
+        self.min_sleep = min_sleep
+        self._lock = threading.Lock()
+        self.schedule = schedule
+        self._schedule_checked_at = 0
 
-    def consume(self, tokens, block=True):
-        """Consume tokens from the bucket. Returns True if there were
-        sufficient tokens.
-        If there are not enough tokens and block is True, sleeps until the
-        bucket is replenished enough to satisfy the deficiency.
-        If there are not enough tokens and block is False, returns False.
-        It is an error to consume more tokens than the bucket capacity.
-        """
-
-        assert tokens <= self.capacity, \
-            'Attempted to consume {} tokens from a bucket with capacity {}'.format(tokens, self.capacity)
+        if schedule is not None:
+            self._check_schedule(self.timestamp)
 
-        if block and tokens > self.tokens:
-            deficit = tokens - self._tokens
-            delay = deficit / self.fill_rate
+    def consume(self, tokens):
+        """Consume tokens from the bucket, sleeping if the bucket doesn't have
+        enough tokens, until it is replenished enough to satisfy the deficiency.
+        Returns the time slept.
+        """
 
-            # print 'Have {} tokens, need {}; sleeping {} seconds'.format(self._tokens, tokens, delay)
+        delay = self.reserve(tokens)
+        if delay:
             sleep(delay)
+        return delay
 
-        if tokens <= self.tokens:
+    def reserve(self, tokens):
+        """Consume tokens from the bucket without sleeping, returns the time
+        the consumer has to wait before using them (0 if the wait is shorter than min_sleep).
+        """
+
+        with self._lock:
+            self._refill()
+            if self.fill_rate is None:
+                return 0
             self._tokens -= tokens
-            return True
-        else:
-            return False
+            deficit = -self._tokens
+            fill_rate = self.fill_rate
 
-    @property
-    def tokens(self):
-        if self._tokens < self.capacity:
-            now = time()
+        if deficit <= 0:
+            return 0
+
+        delay = deficit / fill_rate
+        if delay < self.min_sleep:
+            return 0
+
+        return delay
+
+    def _check_schedule(self, now):
+        self._schedule_checked_at = now
+        rate = self.schedule.current_rate(now)
+
+        if rate is None:
+            self.fill_rate = None
+        elif rate != self.fill_rate:
+            self.capacity = self.fill_rate = float(rate)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def _refill(self):
+        now = time()
+        if self.schedule is not None and now - self._schedule_checked_at >= 1:
+            self._check_schedule(now)
+        if self.fill_rate is not None and self._tokens < self.capacity:
             delta = self.fill_rate * (now - self.timestamp)
             self._tokens = min(self.capacity, self._tokens + delta)
-            self.timestamp = now
-        return self._tokens
+        self.timestamp = now
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+def create_bucket(bandwidth):
+    """Returns the bucket for a bandwidth, provided either as a number or as a RateSchedule."""
+    if isinstance(bandwidth, RateSchedule):
+        return TokenBucket(0, None, schedule=bandwidth)
+    return TokenBucket(bandwidth, bandwidth)
+
+
+_shared_buckets = {}
+_shared_buckets_lock = threading.Lock()
+
+
+def shared_bucket(bandwidth):
+    """Returns the bucket shared by all the downloads limited by the same bandwidth."""
+    with _shared_buckets_lock:
+        if bandwidth not in _shared_buckets:
+            _shared_buckets[bandwidth] = create_bucket(bandwidth)
+        return _shared_buckets[bandwidth]
 
 
-def rate_limit(data, bandwidth_or_burst, steady_state_bandwidth=None):
-    """Limit the bandwidth of a generator.
+def rate_limit(data, bandwidth_or_burst=None, steady_state_bandwidth=None, buckets=()):
+    """Limit the bandwidth of a generator of bytes.
     Given a data generator, return a generator that yields the data at no
-    higher than the specified bandwidth.  For example, ``rate_limit(data, _256k)``
+    higher than the specified bandwidth (or RateSchedule).  For example, ``rate_limit(data, _256k)``
     will yield from data at no higher than 256KB/s.
     The three argument form distinguishes burst from steady-state bandwidth,
     so ``rate_limit(data, 1024 * 1024, 128 * 1024)`` would allow data to be consumed at
     128KB/s with an initial burst of 1MB.
+    Additional buckets (e.g. ``shared_bucket(_1M)``) may be provided to share
+    the limit with other generators.
     """
 
-    bandwidth = steady_state_bandwidth or bandwidth_or_burst
-    rate_limiter = TokenBucket(bandwidth_or_burst, bandwidth)
+    buckets = list(buckets)
+    if isinstance(bandwidth_or_burst, RateSchedule):
+        buckets.append(create_bucket(bandwidth_or_burst))
+    elif bandwidth_or_burst:
+        buckets.append(TokenBucket(bandwidth_or_burst, steady_state_bandwidth or bandwidth_or_burst))
 
     for thing in data:
-        rate_limiter.consume(len(str(thing)))
+        for bucket in buckets:
+            bucket.consume(len(thing))
         yield thing
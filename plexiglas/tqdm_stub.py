@@ -39,5 +39,7 @@ else:
                 log.info(report + appendix)
 
         def close(self):
+            if self._begin is None:
+                return
             report = '%s download complete after %s' % (self.desc, format_timespan(time() - self._begin))
             log.info(report)
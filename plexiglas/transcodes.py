@@ -0,0 +1,152 @@
+"""
+Tracking of the sync items, which have media still being transcoded by the server. Instead of waiting for the next
+iteration, the pending items are polled while the main loop is waiting, and the loop is woken up as soon as some part
+is processed.
+
+Every item is polled with a delay proportional to the estimated time until its next part is processed (the average
+time per part since the tracking has started), within `--transcode-poll-min-delay` and `--transcode-poll-max-delay`;
+while nothing is processed the delay is doubled.
+"""
+
+import threading
+from time import sleep, time
+
+from . import log
+
+_tracker = None
+_lock = threading.Lock()
+
+
+class _PendingItem(object):
+    __slots__ = ['check', 'pending', 'started_at', 'completed', 'last_completed_at', 'delay', 'next_poll_at']
+
+    def __init__(self, check, pending, delay):
+        self.check = check
+        self.pending = pending
+        self.started_at = time()
+        self.completed = 0
+        self.last_completed_at = None
+        self.delay = delay
+        self.next_poll_at = self.started_at + delay
+
+
+class TranscodeTracker(object):
+    def __init__(self, min_delay=10, max_delay=300):
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def track(self, key, check, pending):
+        """
+        Starts or continues tracking of the item.
+
+        :param key: any hashable, which is returned by `poll()` when the item has some new parts processed
+        :param check: function returning the current count of the item's parts, which are not processed yet
+        :param pending: the current count of the parts, which are not processed yet; 0 stops the tracking
+        """
+        with self._lock:
+            if pending <= 0:
+                self._items.pop(key, None)
+                return
+
+            entry = self._items.get(key)
+            if entry is None:
+                log.debug('Waiting for %d parts of %s to be processed', pending, key)
+                self._items[key] = _PendingItem(check, pending, self.min_delay)
+            else:
+                entry.check = check
+                entry.pending = pending
+
+    def retain(self, keys):
+        """ Stops tracking of all the items, except the `keys`. """
+        keys = set(keys)
+        with self._lock:
+            for key in list(self._items):
+                if key not in keys:
+                    del self._items[key]
+
+    def next_poll_at(self):
+        """ Returns the time of the nearest poll, or None if nothing is tracked. """
+        with self._lock:
+            if not self._items:
+                return None
+            return min(entry.next_poll_at for entry in self._items.values())
+
+    def poll(self):
+        """ Checks the items, which are due, returns the keys of the items with new parts processed. """
+        from plexapi.exceptions import PlexApiException
+        from requests import exceptions
+
+        now = time()
+        with self._lock:
+            due = [(key, entry) for key, entry in self._items.items() if entry.next_poll_at <= now]
+
+        ready = []
+        for key, entry in due:
+            try:
+                pending = entry.check()
+            except (exceptions.RequestException, PlexApiException):
+                log.debug('Unable to check the transcoding progress of %s', key, exc_info=True)
+                pending = entry.pending
+
+            now = time()
+            if pending < entry.pending:
+                log.debug('%d parts of %s are processed, %d are left', entry.pending - pending, key, pending)
+                entry.completed += entry.pending - pending
+                entry.last_completed_at = now
+                ready.append(key)
+            entry.pending = pending
+
+            self._schedule(entry, now)
+
+            if pending <= 0:
+                with self._lock:
+                    self._items.pop(key, None)
+
+        return ready
+
+    def _schedule(self, entry, now):
+        expected = None
+        if entry.completed:
+            per_part = (entry.last_completed_at - entry.started_at) / float(entry.completed)
+            expected = entry.last_completed_at + per_part - now
+
+        if expected is not None and expected > 0:
+            entry.delay = expected
+        else:
+            entry.delay *= 2
+
+        entry.delay = min(self.max_delay, max(self.min_delay, entry.delay))
+        entry.next_poll_at = now + entry.delay
+
+
+def get_tracker(opts):
+    """ Returns the tracker shared by all the iterations, or None if the polling is disabled. """
+    global _tracker
+
+    if not opts.transcode_poll_min_delay:
+        return None
+
+    with _lock:
+        if _tracker is None:
+            _tracker = TranscodeTracker(opts.transcode_poll_min_delay, opts.transcode_poll_max_delay)
+        return _tracker
+
+
+def wait(opts, timeout):
+    """ Sleeps for `timeout` seconds, returns earlier if some tracked transcode is finished. """
+    deadline = time() + timeout
+    tracker = get_tracker(opts)
+
+    while True:
+        now = time()
+        poll_at = tracker.next_poll_at() if tracker is not None else None
+        if poll_at is None or poll_at >= deadline:
+            sleep(max(0, deadline - now))
+            return
+
+        sleep(max(0, poll_at - now))
+        if tracker.poll():
+            log.debug('Some transcodes are finished, starting the iteration earlier')
+            return
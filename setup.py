@@ -48,6 +48,9 @@ setup(
     long_description=readme,
     long_description_content_type='text/markdown',
     install_requires=requirements,
+    extras_require={
+        'asyncio': ['aiohttp>=3.3'],
+    },
     dependency_links=dependency_links,
     entry_points={
         'console_scripts': ['plexiglas = plexiglas.cli:main'],
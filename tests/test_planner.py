@@ -0,0 +1,58 @@
+import unittest
+
+from plexiglas.planner import knapsack, select_jobs
+
+
+class Job(object):
+    def __init__(self, name, size, sync_title='Sync'):
+        self.name = name
+        self.size = size
+        self.sync_title = sync_title
+
+
+class KnapsackTestCase(unittest.TestCase):
+    def test_maximizes_value(self):
+        self.assertEqual(knapsack([5, 4, 3], [10, 6, 5], 7), [1, 2])
+        self.assertEqual(knapsack([5, 4, 3], [10, 6, 3], 8), [0, 2])
+
+    def test_nothing_fits(self):
+        self.assertEqual(knapsack([5, 6], [1, 1], 4), [])
+        self.assertEqual(knapsack([5, 6], [1, 1], 0), [])
+        self.assertEqual(knapsack([], [], 10), [])
+
+    def test_rounded_sizes_fit(self):
+        sizes = [1000003, 999999, 1000001, 2000000]
+        selected = knapsack(sizes, [1, 1, 1, 1], 3000000, max_cells=100)
+        self.assertLessEqual(sum(sizes[idx] for idx in selected), 3000000)
+        self.assertTrue(selected)
+
+
+class SelectJobsTestCase(unittest.TestCase):
+    def names(self, jobs):
+        return [j.name for j in jobs]
+
+    def test_everything_fits(self):
+        jobs = [Job('a', 3), Job('b', 4)]
+        self.assertEqual(self.names(select_jobs(jobs, 7)), ['a', 'b'])
+        self.assertEqual(self.names(select_jobs(jobs, None)), ['a', 'b'])
+
+    def test_count_is_maximized_first(self):
+        jobs = [Job('a', 3), Job('b', 3)] + [Job('big%d' % i, 100) for i in range(6)] \
+            + [Job('x1', 2), Job('x2', 2), Job('x3', 2)]
+        self.assertEqual(self.names(select_jobs(jobs, 6)), ['x1', 'x2', 'x3'])
+
+    def test_earlier_jobs_are_preferred(self):
+        jobs = [Job('a', 3), Job('b', 3), Job('c', 3)]
+        self.assertEqual(self.names(select_jobs(jobs, 6)), ['a', 'b'])
+
+        jobs = [Job('a', 4), Job('b', 3), Job('c', 2)]
+        self.assertEqual(self.names(select_jobs(jobs, 6)), ['a', 'c'])
+
+    def test_sync_weights(self):
+        jobs = [Job('a', 2, 'Movies'), Job('b', 2, 'Movies'), Job('c', 4, 'Shows')]
+        self.assertEqual(self.names(select_jobs(jobs, 4)), ['a', 'b'])
+        self.assertEqual(self.names(select_jobs(jobs, 4, {'Shows': 3.0})), ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()